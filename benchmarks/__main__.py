@@ -0,0 +1,333 @@
+"""
+Offline benchmark suite for the hot paths, over synthetic datasets.
+
+Usage:
+    python -m benchmarks run [--sizes 1k 10k 100k] [--output results.json]
+    python -m benchmarks compare base.json new.json [--threshold 0.1]
+    python -m benchmarks golden [--update]
+    python -m benchmarks detectors [--images DIR] [--engines cascades dnn] [--threads 4]
+"""
+import argparse
+import contextlib
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict
+
+from benchmarks import datasets
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GOLDEN_FILE = os.path.join(REPO_DIR, "benchmarks", "golden.json")
+
+
+@contextlib.contextmanager
+def _workdir():
+    """
+    Temporary working directory, since the code under test writes relative to the cwd.
+    The (read only) resources it needs are linked from the repository.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="memorialization_bench_") as workdir:
+        for name in ["resources", "utils"]:
+            os.symlink(os.path.join(REPO_DIR, name), os.path.join(workdir, name))
+        os.chdir(workdir)
+        try:
+            yield workdir
+        finally:
+            os.chdir(cwd)
+
+
+def _measure(func: Callable, repeat: int) -> dict:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {
+        "median": statistics.median(durations),
+        "min": min(durations),
+        "repeat": repeat,
+    }
+
+
+def _records_benchmarks(size_name: str) -> Dict[str, Callable]:
+    from utils.casualty import Casualty
+    from utils.json_storage import reload_data, write_data
+    from utils.collect_external_images import ExternalImagesIndex
+
+    size = datasets.SIZES[size_name]
+    casualties_data = datasets.generate_casualties(size)
+    casualties = [Casualty.from_dict(data) for data in casualties_data]
+    json_path = os.path.abspath(f"casualties_{size_name}.json")
+    write_data(casualties_data, json_path)
+
+    names = datasets.generate_names(size)
+    pool_path = os.path.abspath(f"external_images_{size_name}")
+    datasets.generate_external_images_pool(pool_path, names)
+    index_file = os.path.abspath(f"external_images_index_{size_name}.json")
+    warm_index = ExternalImagesIndex(pool_path, index_file)
+    warm_index.refresh()
+    lookup_names = names[:: max(1, size // 100)]
+
+    def cold_index():
+        if os.path.isfile(index_file):
+            os.remove(index_file)
+        ExternalImagesIndex(pool_path, index_file).refresh()
+
+    return {
+        f"casualty_from_dict[{size_name}]": lambda: [
+            Casualty.from_dict(data) for data in casualties_data
+        ],
+        f"casualty_to_dict[{size_name}]": lambda: [
+            casualty.to_dict() for casualty in casualties
+        ],
+        f"write_data[{size_name}]": lambda: write_data(casualties_data, json_path),
+        f"reload_data[{size_name}]": lambda: reload_data(json_path),
+        f"external_images_pool_index_cold[{size_name}]": cold_index,
+        f"external_images_pool_index_warm[{size_name}]": lambda: ExternalImagesIndex(
+            pool_path, index_file
+        ).refresh(),
+        f"external_images_pool_lookup_x{len(lookup_names)}[{size_name}]": lambda: [
+            warm_index.find(name) for name in lookup_names
+        ],
+    }
+
+
+def _images_benchmarks() -> Dict[str, Callable]:
+    from utils.build_posts import create_casualties_posts, create_casualty_post_worker
+    from utils.images import cut_face, detect_faces, remove_duplicates_images
+    from PIL import Image
+
+    images = datasets.generate_face_images(os.path.abspath("faces"), 10)
+    # Resized copies, to be detected as duplicates
+    duplicates = []
+    for image_path in images[:4]:
+        duplicate_path = f"{image_path}.small.png"
+        with Image.open(image_path) as img:
+            img.resize((img.width // 2, img.height // 2)).save(duplicate_path)
+        duplicates.append(duplicate_path)
+    casualties_data = datasets.generate_casualties(100, images)
+
+    return {
+        f"detect_faces_x{len(images)}": lambda: [detect_faces(path) for path in images],
+        f"cut_face_x{len(images)}": lambda: [cut_face(path) for path in images],
+        f"remove_duplicates_images_x{len(images[:6] + duplicates)}": lambda: remove_duplicates_images(
+            images[:6] + duplicates
+        ),
+        "create_casualty_post_worker_x20": lambda: [
+            create_casualty_post_worker(data) for data in casualties_data[:20]
+        ],
+        f"create_casualties_posts_x{len(casualties_data)}": lambda: create_casualties_posts(
+            casualties_data
+        ),
+    }
+
+
+def run(args: argparse.Namespace) -> None:
+    results = {}
+    with _workdir():
+        benchmarks: Dict[str, Callable] = {}
+        for size_name in args.sizes:
+            benchmarks.update(_records_benchmarks(size_name))
+        if not args.skip_images:
+            benchmarks.update(_images_benchmarks())
+        for name, func in benchmarks.items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = _measure(func, args.repeat)
+            print(f"{name}: {results[name]['median']:.4f} seconds (median)")
+
+    output = {
+        "meta": {
+            "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as fp:
+        json.dump(output, fp, indent=4)
+    print(f"Results were saved to {args.output}")
+
+
+def compare(args: argparse.Namespace) -> None:
+    with open(args.base, "r") as fp:
+        base = json.load(fp)["results"]
+    with open(args.new, "r") as fp:
+        new = json.load(fp)["results"]
+    regressions = []
+    for name in sorted(base.keys() & new.keys()):
+        ratio = new[name]["median"] / base[name]["median"]
+        flag = ""
+        if 1 + args.threshold < ratio:
+            flag = "  <-- REGRESSION"
+            regressions.append(name)
+        print(
+            f"{name}: {base[name]['median']:.4f} -> {new[name]['median']:.4f} seconds (x{ratio:.2f}){flag}"
+        )
+    for name in sorted(base.keys() ^ new.keys()):
+        print(f"{name}: exists only in {'base' if name in base else 'new'} results")
+    if regressions:
+        print(f"\n{len(regressions)} regressions (slower by more than {args.threshold:.0%})")
+        sys.exit(1)
+
+
+def _pixels_hash(path: str) -> str:
+    from PIL import Image
+
+    with Image.open(path) as img:
+        return hashlib.sha256(
+            f"{img.mode}{img.size}".encode() + img.tobytes()
+        ).hexdigest()
+
+
+def _render_golden_posts() -> Dict[str, str]:
+    """Render a fixed set of posts and return the path of each (None if it failed to render)"""
+    from utils.build_posts import create_casualty_post_worker
+
+    images = datasets.generate_face_images(os.path.abspath("faces"), 3)
+    casualties_data = datasets.generate_casualties(6, images, seed=1)
+    casualties_data[-1]["post_main_image"] = None
+    renders = {}
+    for casualty_data in casualties_data:
+        post_path = create_casualty_post_worker(casualty_data)["post_path"]
+        renders[casualty_data["data_url"]] = post_path
+    return renders
+
+
+def golden(args: argparse.Namespace) -> None:
+    output_dir = os.path.abspath(args.output_dir)
+    if not args.update and not os.path.isfile(GOLDEN_FILE):
+        sys.exit(
+            f"The golden hashes file {GOLDEN_FILE} is missing. Save the golden renders first, "
+            'with "python -m benchmarks golden --update" (on the code before the change)'
+        )
+    with _workdir():
+        renders = _render_golden_posts()
+        hashes = {url: _pixels_hash(path) if path else None for url, path in renders.items()}
+        if args.update:
+            with open(GOLDEN_FILE, "w") as fp:
+                json.dump(hashes, fp, indent=4)
+            print(f"{len(hashes)} golden hashes were saved to {GOLDEN_FILE}")
+            return
+        with open(GOLDEN_FILE, "r") as fp:
+            expected = json.load(fp)
+        mismatches = [url for url in expected if hashes.get(url) != expected[url]]
+        if mismatches:
+            os.makedirs(output_dir, exist_ok=True)
+            for url in mismatches:
+                if renders.get(url):
+                    shutil.copy(
+                        renders[url],
+                        os.path.join(output_dir, os.path.basename(renders[url])),
+                    )
+            print(
+                f"{len(mismatches)} of {len(expected)} posts are not pixel-identical to the golden ones "
+                f"(the renders were saved to {output_dir})"
+            )
+            sys.exit(1)
+        print(f"All the {len(expected)} posts are pixel-identical to the golden ones")
+
+
+def detectors(args: argparse.Namespace) -> None:
+    """Compare the latency and the hit rate (exactly one face found) of the face detection engines"""
+    import cv2
+    from utils.face_detectors import create_detector
+
+    images_dir = os.path.abspath(args.images) if args.images else None
+    with _workdir():
+        if images_dir:
+            images = sorted(
+                os.path.join(root, name)
+                for root, _, files in os.walk(images_dir)
+                for name in files
+                if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg", ".png")
+            )
+        else:
+            images = datasets.generate_face_images(os.path.abspath("faces"), 20)
+        decoded = [img for img in (cv2.imread(path) for path in images) if img is not None]
+        print(f"{len(decoded)} images")
+        if not decoded:
+            return
+        for engine in args.engines:
+            detector = create_detector(engine, concurrency=args.threads)
+            durations, hits = [], 0
+            for img in decoded:
+                start = time.perf_counter()
+                faces = detector.detect(img)
+                durations.append(time.perf_counter() - start)
+                hits += len(faces) == 1
+            print(
+                f"{engine} ({detector.name}): {statistics.median(durations) * 1000:.1f} ms median, "
+                f"{max(durations) * 1000:.1f} ms max, hit rate {hits / len(decoded):.1%}"
+            )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument(
+        "--sizes", nargs="+", choices=list(datasets.SIZES), default=["1k", "10k"]
+    )
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--filter", help="Run only benchmarks containing this text")
+    run_parser.add_argument(
+        "--skip_images", action="store_true", help="Skip the images processing benchmarks"
+    )
+    run_parser.add_argument("--output", default="bench_results.json")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two results files and flag regressions"
+    )
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="Allowed slowdown ratio"
+    )
+    compare_parser.set_defaults(func=compare)
+
+    golden_parser = subparsers.add_parser(
+        "golden", help="Check that rendered posts are pixel-identical to the golden ones"
+    )
+    golden_parser.add_argument(
+        "--update", action="store_true", help="Save the current renders as the golden ones"
+    )
+    golden_parser.add_argument("--output_dir", default="golden_mismatches")
+    golden_parser.set_defaults(func=golden)
+
+    detectors_parser = subparsers.add_parser(
+        "detectors", help="Compare the face detection engines latency and hit rate"
+    )
+    detectors_parser.add_argument(
+        "--images", help="Directory of images to detect in (synthetic faces by default)"
+    )
+    detectors_parser.add_argument(
+        "--engines", nargs="+", default=["cascades", "dnn"]
+    )
+    detectors_parser.add_argument(
+        "--threads", type=int, default=0, help="Run the cascades speculatively on threads"
+    )
+    detectors_parser.set_defaults(func=detectors)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
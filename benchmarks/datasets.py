@@ -0,0 +1,104 @@
+"""Synthetic, reproducible datasets for the benchmarks"""
+import os
+import random
+from pathlib import Path
+from typing import List
+
+from benchmarks.text import random_word
+
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+
+DEGREES = ['סמ"ר', 'סג"מ', "רב\"ט", 'רס"ב', "סרן"]
+DEPARTMENTS = ["חטיבת גולני", "חטיבת הצנחנים", "חיל השריון", None]
+CITIES = ["ירושלים", "תל אביב", "חיפה", "באר שבע", "רהט", None]
+
+
+def generate_names(count: int, seed: int = 0) -> List[str]:
+    rnd = random.Random(seed)
+    return [f"{random_word(rnd)} {random_word(rnd)}" for _ in range(count)]
+
+
+def generate_casualties(
+    count: int, images: List[str] | None = None, seed: int = 0
+) -> List[dict]:
+    """Generate casualties records, in the dataset JSON format"""
+    rnd = random.Random(seed)
+    names = generate_names(count, seed)
+    casualties = []
+    for i, name in enumerate(names):
+        images_paths = rnd.sample(images, min(len(images), 3)) if images else []
+        casualties.append(
+            {
+                "data_url": f"https://www.idf.il/synthetic/{i}/",
+                "full_name": name,
+                "degree": rnd.choice(DEGREES),
+                "department": rnd.choice(DEPARTMENTS),
+                "living_city": rnd.choice(CITIES),
+                "grave_city": None,
+                "age": rnd.randint(18, 60),
+                "gender": rnd.choice(["M", "F"]),
+                "date_of_death_str": f"2023-{rnd.randint(10, 12)}-{rnd.randint(1, 28):02}",
+                "post_main_image": images_paths[0] if images_paths else None,
+                "post_additional_images": images_paths[1:],
+                "post_path": None,
+                "post_caption": None,
+                "post_tested": False,
+                "post_published": False,
+            }
+        )
+    return casualties
+
+
+def generate_face_image(path: str, seed: int = 0, size=(480, 600)) -> str:
+    """Draw a synthetic face (head, eyes, nose and mouth) over a noisy background"""
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(seed)
+    img = Image.frombytes("L", size, rnd.randbytes(size[0] * size[1])).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    face_width = rnd.randint(width // 3, width // 2)
+    face_height = int(face_width * 1.3)
+    left = rnd.randint(0, width - face_width)
+    top = rnd.randint(0, height - face_height)
+    skin = (rnd.randint(150, 230), rnd.randint(110, 180), rnd.randint(80, 150))
+    draw.ellipse((left, top, left + face_width, top + face_height), fill=skin)
+    eye_y = top + face_height * 0.4
+    eye_size = face_width * 0.12
+    for eye_x in (left + face_width * 0.3, left + face_width * 0.7):
+        draw.ellipse(
+            (eye_x - eye_size, eye_y - eye_size / 2, eye_x + eye_size, eye_y + eye_size / 2),
+            fill=(30, 30, 30),
+        )
+    nose_x, nose_y = left + face_width / 2, top + face_height * 0.6
+    draw.line((nose_x, eye_y, nose_x, nose_y), fill=(90, 60, 40), width=3)
+    mouth_y = top + face_height * 0.75
+    draw.arc(
+        (left + face_width * 0.3, mouth_y - 15, left + face_width * 0.7, mouth_y + 15),
+        0,
+        180,
+        fill=(120, 30, 30),
+        width=4,
+    )
+    Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+    img.save(path)
+    return path
+
+
+def generate_face_images(target_dir: str, count: int, seed: int = 0) -> List[str]:
+    return [
+        generate_face_image(os.path.join(target_dir, f"face_{i}.png"), seed + i)
+        for i in range(count)
+    ]
+
+
+def generate_external_images_pool(
+    target_dir: str, names: List[str], files_per_dir: int = 200, seed: int = 0
+) -> None:
+    """Create an external images pool with (empty) image files named after the given names"""
+    rnd = random.Random(seed)
+    for i, name in enumerate(names):
+        dir_path = os.path.join(target_dir, f"dir_{i // files_per_dir}")
+        Path(dir_path).mkdir(parents=True, exist_ok=True)
+        suffix = rnd.choice(["jpg", "png", "jpeg"])
+        Path(os.path.join(dir_path, f"{name}_{rnd.randint(18, 60)}.{suffix}")).touch()
@@ -0,0 +1,71 @@
+"""
+Benchmark of matching casualties names in external posts captions:
+the names automaton (utils.name_matcher) vs. a substring test per name per caption.
+
+Usage: python -m benchmarks.name_matcher [--names 5000] [--captions 50000]
+"""
+import argparse
+import random
+import time
+from dataclasses import dataclass
+from typing import Dict, List
+
+from benchmarks.text import random_word
+from utils.name_matcher import match_names
+
+
+@dataclass
+class _Post:
+    text: str
+
+
+def generate_dataset(names_count: int, captions_count: int, seed: int = 0):
+    """Generate synthetic names and captions, where some of the captions mention some of the names"""
+    rnd = random.Random(seed)
+    names = [f"{random_word(rnd)} {random_word(rnd)}" for _ in range(names_count)]
+    posts = []
+    for _ in range(captions_count):
+        words = [random_word(rnd) for _ in range(rnd.randint(20, 60))]
+        if rnd.random() < 0.3:
+            words.insert(rnd.randrange(len(words)), f'{rnd.choice(names)} ז"ל')
+        posts.append(_Post(" ".join(words)))
+    return names, posts
+
+
+def naive_match(names: List[str], posts: List[_Post]) -> Dict[str, List[_Post]]:
+    """The original matching - a substring test per name per caption"""
+    names_posts = {}
+    for name in names:
+        matched = [post for post in posts if name in post.text]
+        if matched:
+            names_posts[name] = matched
+    return names_posts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--names", type=int, default=5000)
+    parser.add_argument("--captions", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    names, posts = generate_dataset(args.names, args.captions, args.seed)
+    print(f"{len(names)} names x {len(posts)} captions")
+
+    start = time.perf_counter()
+    automaton_result = match_names(names, posts)
+    automaton_seconds = time.perf_counter() - start
+    print(f"Names automaton: {automaton_seconds:.2f} seconds")
+
+    start = time.perf_counter()
+    naive_result = naive_match(names, posts)
+    naive_seconds = time.perf_counter() - start
+    print(f"Substring loop: {naive_seconds:.2f} seconds")
+
+    print(f"Speedup: x{naive_seconds / automaton_seconds:.1f}")
+    missed = set(naive_result) - set(automaton_result)
+    print(f"Names found by the substring loop only: {len(missed)}")
+
+
+if __name__ == "__main__":
+    main()
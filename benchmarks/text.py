@@ -0,0 +1,8 @@
+"""Synthetic Hebrew text, shared by the benchmarks datasets"""
+import random
+
+HEBREW_LETTERS = "אבגדהוזחטיכלמנסעפצקרשת"
+
+
+def random_word(rnd: random.Random) -> str:
+    return "".join(rnd.choice(HEBREW_LETTERS) for _ in range(rnd.randint(2, 7)))
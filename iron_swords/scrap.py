@@ -375,29 +375,61 @@
 #     return [casualty.to_dict() for casualty in casualties]
 
 
+import glob
+import hashlib
 import os
-from PIL import features
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 import re
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, Generator, List, Optional, Tuple
+from urllib.parse import urlparse
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service as ChromeService
-from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from iron_swords.paths import IMAGES_DIR
 from utils.casualty import Casualty, Gender
 from utils.collect_external_images import find_images_in_external_images_pool
-from utils.collect_external_posts import find_images_in_external_posts
+from utils import logs, metrics
+from utils.http_cache import HttpCache, OfflineCacheMiss
+from utils.image_store import DATASET_SOURCE, EXTERNAL_IMAGES_SOURCE, ImageStore
+from utils.shards import Shard, shard_of
+
+_log = logs.get_logger(__name__)
 
 chrome_options = webdriver.ChromeOptions()
 chrome_options.add_argument("--headless")
 
-def collect_casualties_urls(main_url: str, page_limit: Optional[int] = None) -> List[str]:
-    """Return a list with the URLs of all the casualties pages"""
-    urls = []
+IMAGES_DOWNLOAD_THREADS = 8
+IMAGES_DOWNLOAD_LOOKAHEAD = 4  # Maximal number of casualties whose images are still downloaded
+_images_executor_instance: ThreadPoolExecutor | None = None
+_images_executor_pid: int | None = None
+
+CASUALTIES_LIST_URL = "https://www.idf.il/%D7%A0%D7%95%D7%A4%D7%9C%D7%99%D7%9D/%D7%97%D7%9C%D7%9C%D7%99-%D7%97%D7%A8%D7%91%D7%95%D7%AA-%D7%91%D7%A8%D7%96%D7%9C/"
+
+def _card_fingerprint(casualty_item) -> str:
+    """Cheap fingerprint of a casualty page, by its card in the listing (text and image)"""
+    images = casualty_item.find_elements(By.TAG_NAME, "img")
+    content = "\n".join(
+        [casualty_item.get_attribute("innerText") or ""]
+        + [image.get_attribute("src") or "" for image in images]
+    )
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+def collect_casualties_cards(main_url: str, page_limit: Optional[int] = None) -> Dict[str, str]:
+    """
+    Return the URLs of all the casualties pages, along with the fingerprints of their cards
+    (from the stored listing, in offline mode)
+    """
+    cache = HttpCache()
+    snapshot_key = f"{main_url}#pages={page_limit}"
+    if cache.offline:
+        snapshot = cache.load_snapshot(snapshot_key)
+        return snapshot.get("cards") or dict.fromkeys(snapshot["urls"])
+    cards = {}
     pages = 1
     with webdriver.Chrome(
             service=ChromeService(), options=chrome_options
@@ -411,8 +443,8 @@ def collect_casualties_urls(main_url: str, page_limit: Optional[int] = None) ->
                 casualty_items = driver.find_elements(By.CLASS_NAME, "casualty-item")
                 for casualty_item in casualty_items:
                     url = casualty_item.find_element(By.XPATH, "..").get_attribute("href")
-                    urls.append(url)
-                print(f"{len(urls)} URLs were collected")
+                    cards[url] = _card_fingerprint(casualty_item)
+                _log.info("Casualties URLs were collected", extra={"urls": len(cards), "pages": pages})
                 pages += 1
                 if page_limit < 2:
                     break
@@ -422,7 +454,12 @@ def collect_casualties_urls(main_url: str, page_limit: Optional[int] = None) ->
                 next_page_btn.click()
             except Exception:
                 break
-    return urls
+    cache.store_snapshot(snapshot_key, {"urls": list(cards), "cards": cards})
+    return cards
+
+def collect_casualties_urls(main_url: str, page_limit: Optional[int] = None) -> List[str]:
+    """Return a list with the URLs of all the casualties pages"""
+    return list(collect_casualties_cards(main_url, page_limit))
 
 def re_search(pattern: str, txt: str) -> Optional[str]:
     """Search for a match and return it."""
@@ -439,92 +476,194 @@ def sanitize_filename(filename: str) -> str:
     filename = filename[:100] if filename else 'default_name'
     return filename
 
-def collect_casualty(url: str) -> Casualty:
-    """Scrap the casualty page, parse his data and return it"""
+def _render_casualty_page(driver: webdriver.Chrome, url: str) -> dict:
+    """The rendered content of the casualty page, which is required for parsing it"""
+    driver.get(url)
+    WebDriverWait(driver, 60).until(
+        EC.presence_of_element_located((By.CLASS_NAME, "soldier-image"))
+    )
+    section = (
+        driver.find_element(By.CLASS_NAME, "share-section")
+        .get_attribute("innerText")
+        .replace("\n\n", "\n")
+    )
+    try:
+        img_url = driver.find_element(By.CLASS_NAME, "soldier-image").find_element(
+            By.CLASS_NAME, "img-fluid"
+        ).get_attribute("src")
+    except Exception:
+        img_url = None
+    return {"section": section, "img_url": img_url}
+
+def _parse_casualty_page(url: str, page: dict) -> Casualty:
+    """Parse the casualty data (without the images) out of the rendered page content"""
+    section = page["section"]
+    full_name = section.split("\n")[0].replace(' ז"ל', "")
+    degree, full_name = full_name.split(" ", 1)
+    if full_name[0] == "(":
+        degree_cont, full_name = full_name.split(" ", 1)
+        degree = degree + " " + degree_cont
+    date_of_death_str = re_search(r"(?:נפל.? ביום .*?)(\d+\.\d+\.\d+)", section)
+    date_of_death_str = (
+        datetime.strptime(date_of_death_str, "%d.%m.%Y").strftime("%Y-%m-%d")
+        if date_of_death_str
+        else None
+    )
+    age = re_search(r"(?:בן|בת) (\d+)", section)
+    age = int(age) if age else None
+    gender = (
+        Gender.MALE if "בן" in section
+        else Gender.FEMALE if "בת" in section
+        else None
+    )
+    living_city = re_search(r"(?:, מ)(.*?)(?:,)", section)
+    grave_city = re_search(r"(בית העלמין.*?)(?:\\.)", section)
+    return Casualty(
+        data_url=url,
+        full_name=full_name,
+        degree=degree,
+        department=section.split("\n")[1],
+        living_city=living_city,
+        grave_city=grave_city,
+        age=age,
+        gender=gender,
+        date_of_death_str=date_of_death_str,
+        post_main_image=None,
+        post_additional_images=[],
+    )
+
+def _images_paths(casualty: Casualty) -> Tuple[str, str]:
+    """The paths of the small and the big images of the casualty (without their suffixes)"""
+    # Sanitize file name components
+    sanitized_name = sanitize_filename(casualty.full_name)
+    sanitized_city = sanitize_filename(casualty.living_city) if casualty.living_city else "unknown"
+    sanitized_filename = f"{sanitized_name}_{casualty.age}_{sanitized_city}"
+    return (
+        os.path.join(os.getcwd(), IMAGES_DIR, f"{sanitized_filename}_small"),
+        os.path.join(os.getcwd(), IMAGES_DIR, f"{sanitized_filename}_big"),
+    )
+
+def _saved_image_path(path: str) -> Optional[str]:
+    """The latest saved image of the path, whatever its suffix is (originals, or older PNG screenshots)"""
+    saved_paths = glob.glob(f"{glob.escape(path)}.*")
+    return max(saved_paths, key=os.path.getmtime) if saved_paths else None
+
+def _add_saved_images(casualty: Casualty, require_all: bool = False) -> bool:
+    """Add the previously saved images of the casualty. Return whether they were added."""
+    small_img_path, big_img_path = (_saved_image_path(path) for path in _images_paths(casualty))
+    if require_all and not (small_img_path and big_img_path):
+        return False
+    if small_img_path:
+        casualty.post_main_image = ImageStore().add_file(small_img_path, source=DATASET_SOURCE)
+    if big_img_path:
+        casualty.post_additional_images = [
+            ImageStore().add_file(big_img_path, source=DATASET_SOURCE)
+        ]
+    return True
+
+def _images_executor() -> ThreadPoolExecutor:
+    global _images_executor_instance, _images_executor_pid
+    # A forked process doesn't inherit the threads of its parent, so it needs its own executor
+    if _images_executor_instance is None or _images_executor_pid != os.getpid():
+        _images_executor_instance = ThreadPoolExecutor(
+            max_workers=IMAGES_DOWNLOAD_THREADS, thread_name_prefix="images_download"
+        )
+        _images_executor_pid = os.getpid()
+    return _images_executor_instance
+
+def _download_image(url: str, path: str) -> str:
+    """Download the original image next to the given path (with the suffix of the URL), and return its blob path"""
+    suffix = os.path.splitext(urlparse(url).path)[1] or ".jpg"
+    return HttpCache().download_image(url, [f"{path}{suffix}"], DATASET_SOURCE)
+
+@metrics.timed("collect_casualty_seconds")
+def _start_collect_casualty(url: str) -> Tuple[Casualty, List[Tuple[str, Future]]]:
+    """
+    Collect the casualty data from its page, and start downloading its images in the background.
+    Return the casualty, along with its images downloads (by their kind, "small" or "big").
+    The rendered page is stored in the HTTP cache, so in offline mode the casualty is parsed
+    from the stored page, along with its previously saved images.
+    """
+    cache = HttpCache()
+    if cache.offline:
+        casualty = _parse_casualty_page(url, cache.load_snapshot(url))
+        _add_saved_images(casualty)
+        return casualty, []
+    try:
+        previous_page = cache.load_snapshot(url)
+    except OfflineCacheMiss:
+        previous_page = None
     with webdriver.Chrome(
             service=ChromeService(), options=chrome_options
     ) as driver:
-        driver.get(url)
-        WebDriverWait(driver, 60).until(
-            EC.presence_of_element_located((By.CLASS_NAME, "soldier-image"))
-        )
-        section = (
-            driver.find_element(By.CLASS_NAME, "share-section")
-            .get_attribute("innerText")
-            .replace("\n\n", "\n")
-        )
-        full_name = section.split("\n")[0].replace(' ז"ל', "")
-        degree, full_name = full_name.split(" ", 1)
-        if full_name[0] == "(":
-            degree_cont, full_name = full_name.split(" ", 1)
-            degree = degree + " " + degree_cont
-        date_of_death_str = re_search(r"(?:נפל.? ביום .*?)(\d+\.\d+\.\d+)", section)
-        date_of_death_str = (
-            datetime.strptime(date_of_death_str, "%d.%m.%Y").strftime("%Y-%m-%d")
-            if date_of_death_str
-            else None
-        )
-        age = re_search(r"(?:בן|בת) (\d+)", section)
-        age = int(age) if age else None
-        gender = (
-            Gender.MALE if "בן" in section
-            else Gender.FEMALE if "בת" in section
-            else None
-        )
-        living_city = re_search(r"(?:, מ)(.*?)(?:,)", section)
-        grave_city = re_search(r"(בית העלמין.*?)(?:\\.)", section)
-        post_main_image, post_additional_images = None, []
+        page = _render_casualty_page(driver, url)
+    cache.store_snapshot(url, page)
+    casualty = _parse_casualty_page(url, page)
+    img_url = page["img_url"]
+    if not img_url or "candle" in img_url:
+        return casualty, []
+    if (
+            previous_page
+            and previous_page.get("img_url") == img_url
+            and _add_saved_images(casualty, require_all=True)
+    ):
+        # The image wasn't changed since it was saved
+        metrics.increment("collect_casualty_images", result="reused")
+        return casualty, []
+    Path(IMAGES_DIR).mkdir(parents=True, exist_ok=True)
+    small_img_path, big_img_path = _images_paths(casualty)
+    # The small image is the resized one of the page, and the big one is the original (without the resize query)
+    big_img_url = img_url[:img_url.rindex("?")] if "?" in img_url else img_url
+    return casualty, [
+        ("small", _images_executor().submit(_download_image, img_url, small_img_path)),
+        ("big", _images_executor().submit(_download_image, big_img_url, big_img_path)),
+    ]
+
+def _finish_collect_casualty(
+        casualty: Casualty, downloads: List[Tuple[str, Future]]
+) -> Casualty:
+    """Wait for the images downloads of the casualty, and add the downloaded images"""
+    for kind, download in downloads:
         try:
-            small_img = driver.find_element(By.CLASS_NAME, "soldier-image").find_element(
-                By.CLASS_NAME, "img-fluid"
-            )
-            img_url = small_img.get_attribute("src")
-            if img_url and "candle" not in img_url:
-                Path(IMAGES_DIR).mkdir(parents=True, exist_ok=True)
-                # Sanitize file name components
-                sanitized_name = sanitize_filename(full_name)
-                sanitized_city = sanitize_filename(living_city) if living_city else "unknown"
-                sanitized_filename = f"{sanitized_name}_{age}_{sanitized_city}"
-                small_img_path = os.path.join(os.getcwd(), IMAGES_DIR, f"{sanitized_filename}_small.png")
-                big_img_path = os.path.join(os.getcwd(), IMAGES_DIR, f"{sanitized_filename}_big.png")
-                print(f"Attempting to save small image: {small_img_path}")
-                try:
-                    small_img.screenshot(small_img_path)
-                    post_main_image = small_img_path
-                    print(f"Saved small image: {small_img_path}")
-                except Exception as e:
-                    print(f"Failed to save small image for {full_name}: {e}")
-                if img_url:
-                    img_url = img_url[:img_url.rindex("?")]
-                    driver.get(img_url)
-                    WebDriverWait(driver, 60).until(
-                        EC.presence_of_element_located((By.TAG_NAME, "img"))
-                    )
-                    big_img = driver.find_element(By.TAG_NAME, "img")
-                    print(f"Attempting to save big image: {big_img_path}")
-                    try:
-                        big_img.screenshot(big_img_path)
-                        post_additional_images = [big_img_path]
-                        print(f"Saved big image: {big_img_path}")
-                    except Exception as e:
-                        print(f"Failed to save big image for {full_name}: {e}")
-        except Exception as e:
-            print(f"Failed to process images for {full_name}: {e}")
-        casualty = Casualty(
-            data_url=url,
-            full_name=full_name,
-            degree=degree,
-            department=section.split("\n")[1],
-            living_city=living_city,
-            grave_city=grave_city,
-            age=age,
-            gender=gender,
-            date_of_death_str=date_of_death_str,
-            post_main_image=post_main_image,
-            post_additional_images=post_additional_images,
-        )
+            img_path = download.result()
+        except Exception:
+            metrics.increment("collect_casualty_images", result="failed")
+            _log.warning("Failed to save %s image for %s", kind, casualty, exc_info=True)
+            continue
+        metrics.increment("collect_casualty_images", result="downloaded")
+        if kind == "small":
+            casualty.post_main_image = img_path
+        else:
+            casualty.post_additional_images = [img_path]
     return casualty
 
+def collect_casualty(url: str) -> Casualty:
+    """Collect the casualty data from its page, along with its images"""
+    return _finish_collect_casualty(*_start_collect_casualty(url))
+
+def _collect_casualties(urls: List[str]) -> Generator[Tuple[str, Casualty | Exception], None, None]:
+    """
+    Collect the casualties of the URLs, in order, yielding each casualty (or the error of its
+    collection). The images of each casualty are downloaded while the next pages are collected.
+    """
+    def finish(url: str, started) -> Tuple[str, Casualty | Exception]:
+        return url, started if isinstance(started, Exception) else _finish_collect_casualty(*started)
+
+    pending = deque()
+    for url in urls:
+        try:
+            pending.append((url, _start_collect_casualty(url)))
+        except Exception as e:
+            pending.append((url, e))
+        while pending and (
+                IMAGES_DOWNLOAD_LOOKAHEAD < len(pending)
+                or isinstance(pending[0][1], Exception)
+                or all(download.done() for _, download in pending[0][1][1])
+        ):
+            yield finish(*pending.popleft())
+    while pending:
+        yield finish(*pending.popleft())
+
 def sanitize_filename(filename: str) -> str:
     """Sanitize the filename to keep Hebrew and remove invalid characters"""
     illegal_characters = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
@@ -535,92 +674,228 @@ def sanitize_filename(filename: str) -> str:
     filename = filename[:100] if filename else 'default_name'
     return filename
 
-def add_casualty_images_from_external_resources(
-        casualty: Casualty, instagram_user: str, intagram_password: str, redownload: bool
+def add_casualties_images_from_external_resources(
+        casualties: List[Casualty], instagram_user: str, intagram_password: str, redownload: bool
 ) -> None:
-    """Look for the casualty name in other posts. If exists, add images from these posts."""
-    print(f'casualty.full_name:{casualty.full_name},instagram_user: {instagram_user}, intagram_password:{intagram_password}')
-    casualty.post_additional_images.extend(
-        find_images_in_external_posts(
-            full_name=casualty.full_name,
-            instagram_accounts=["remember_haravot_barzel"],
-            instagram_user=instagram_user,
-            intagram_password=intagram_password,
-            redownload=redownload,
-        )
+    """
+    Look for the names of the casualties awaiting publication in other posts (all at once, so every
+    caption is scanned only once), and in the external images pool. If exist, add their images.
+    """
+    # Imported here, as it requires instaloader, instagrapi and cv2, which are not needed otherwise
+    from utils.collect_external_posts import find_images_in_external_posts_by_names
+
+    casualties = [casualty for casualty in casualties if not casualty.post_published]
+    _log.debug(
+        "Looking for external images",
+        extra={"instagram_user": instagram_user, "casualties": len(casualties)},
     )
-    casualty.post_additional_images.extend(
-        find_images_in_external_images_pool(full_name=casualty.full_name)
+    names_images = find_images_in_external_posts_by_names(
+        full_names=[casualty.full_name for casualty in casualties],
+        instagram_accounts=["remember_haravot_barzel"],
+        instagram_user=instagram_user,
+        intagram_password=intagram_password,
+        redownload=redownload,
     )
-    casualty.post_additional_images = list(set(casualty.post_additional_images))
-    casualty.post_additional_images = [
-        path for path in casualty.post_additional_images if os.path.isfile(path)
+    for casualty in casualties:
+        # The images of the IDF page, which are kept first in the post (the set below loses the order)
+        idf_images = set(casualty.post_additional_images)
+        casualty.post_additional_images.extend(names_images[casualty.full_name])
+        casualty.post_additional_images.extend(
+            ImageStore().add_file(path, source=EXTERNAL_IMAGES_SOURCE)
+            for path in find_images_in_external_images_pool(full_name=casualty.full_name)
+        )
+        casualty.post_additional_images = list(set(casualty.post_additional_images))
+        casualty.post_additional_images = [
+            path for path in casualty.post_additional_images if os.path.isfile(path)
+        ]
+        casualty.post_additional_images.sort(key=lambda path: path not in idf_images)
+
+def _set_main_image(casualty: Casualty) -> None:
+    """Use the first additional image as the main image, if the casualty has no main image"""
+    if not casualty.post_main_image and casualty.post_additional_images:
+        casualty.post_main_image = casualty.post_additional_images[0]
+        casualty.post_additional_images = casualty.post_additional_images[1:]
+
+def _add_casualty(
+        casualties: List[Casualty], exist_names: Dict[str, Casualty], casualty: Casualty
+) -> Casualty:
+    """
+    Add the casualty of a new URL to the casualties, by the identity rules:
+    a casualty with the same name, age and living city is the same one - and if its post was
+    already published, it's kept, only with the new URL.
+    """
+    if casualty.full_name in exist_names:
+        exist_casualty = exist_names[casualty.full_name]
+        if (
+                exist_casualty.age == casualty.age
+                and exist_casualty.living_city == casualty.living_city
+        ):
+            if exist_casualty.post_published:
+                exist_casualty = exist_names[casualty.full_name]
+                _log.warning(
+                    "The post about %s was already published, but the URL was changed",
+                    casualty,
+                    extra={"previous_url": exist_casualty.data_url, "url": casualty.data_url},
+                )
+                exist_casualty.data_url = casualty.data_url
+                casualty = exist_casualty
+            if exist_casualty in casualties:
+                casualties.remove(exist_casualty)
+    casualties.append(casualty)
+    return casualty
+
+def _changed_fields(previous: Casualty, current: Casualty) -> List[str]:
+    """The names of the collected fields which were changed"""
+    return [
+        field
+        for field, value in current.to_dict().items()
+        if not field.startswith("post_") or field in ("post_main_image", "post_additional_images")
+        if field != "page_fingerprint" and previous.to_dict().get(field) != value
     ]
-    casualty.post_additional_images.sort(key=lambda path: IMAGES_DIR not in path)
 
-def collect_casualties_data(
+def iter_casualties_data(
         casualties_data: List[dict],
         instagram_user: str,
         intagram_password: str,
         page_limit: int | None = None,
         recollect: bool = False,
-) -> List[dict]:
-    """Collect casualties data from the IDF website"""
+        shard: Shard | None = None,
+) -> Generator[dict, None, List[dict]]:
+    """
+    Collect casualties data from the IDF website.
+    Yield each collected casualty as soon as it's ready, and finally return the whole updated data.
+    If a shard is given, only its slice of the casualties URLs is collected.
+    """
     casualties: List[Casualty] = [
         Casualty.from_dict(casualty_data) for casualty_data in casualties_data
     ]
+    cards = collect_casualties_cards(CASUALTIES_LIST_URL, page_limit)
+    urls = list(cards)
+    if shard:
+        urls = [url for url in urls if shard_of(url, shard.count) == shard.index]
+    # On recollect, only the unpublished casualties whose listing cards were changed
+    # (or which have no fingerprint yet) are collected again. Offline, all of them are re-parsed.
+    recollected: Dict[str, Casualty] = {}
     if recollect:
-        casualties = [casualty for casualty in casualties if casualty.post_published]
+        urls_keys = {url.replace("https://", ""): url for url in urls}
+        for casualty in list(casualties):
+            url_key = casualty.data_url.replace("https://", "")
+            if (
+                    not casualty.post_published
+                    and url_key in urls_keys
+                    and (
+                        HttpCache().offline
+                        or not casualty.page_fingerprint
+                        or casualty.page_fingerprint != cards[urls_keys[url_key]]
+                    )
+            ):
+                casualties.remove(casualty)
+                recollected[url_key] = casualty
     exist_urls = {
         casualty.data_url.replace("https://", ""): casualty for casualty in casualties
     }
     exist_names = {casualty.full_name: casualty for casualty in casualties}
     new_urls_counter = 0
     errors_urls_counter = 0
-    urls = collect_casualties_urls(
-        "https://www.idf.il/%D7%A0%D7%95%D7%A4%D7%9C%D7%99%D7%9D/%D7%97%D7%9C%D7%9C%D7%99-%D7%97%D7%A8%D7%91%D7%95%D7%AA-%D7%91%D7%A8%D7%96%D7%9C/",
-        page_limit,
-    )
-    for url in urls:
-        if url.replace("https://", "") not in exist_urls:
+    changes = []
+    new_urls = [url for url in urls if url.replace("https://", "") not in exist_urls]
+    for url, collected_casualty in _collect_casualties(new_urls):
+        url_key = url.replace("https://", "")
+        collected_data = None
+        with logs.correlation(url):
             try:
-                casualty = collect_casualty(url)
-                if casualty.full_name in exist_names:
-                    exist_casualty = exist_names[casualty.full_name]
-                    if (
-                            exist_casualty.age == casualty.age
-                            and exist_casualty.living_city == casualty.living_city
-                    ):
-                        if exist_casualty.post_published:
-                            exist_casualty = exist_names[casualty.full_name]
-                            print(
-                                f"""
-                                Warning! The post about {casualty} was already published, but the URL was changes:
-                                {exist_casualty.data_url}
-                                -> {casualty.data_url}
-                            """
-                            )
-                            exist_casualty.data_url = casualty.data_url
-                            casualty = exist_casualty
-                        if exist_casualty in casualties:
-                            casualties.remove(exist_casualty)
-                casualties.append(casualty)
+                if isinstance(collected_casualty, Exception):
+                    raise collected_casualty
+                collected_casualty.page_fingerprint = cards[url] or (
+                    recollected[url_key].page_fingerprint if url_key in recollected else None
+                )
+                if url_key in recollected:
+                    changed_fields = _changed_fields(recollected[url_key], collected_casualty)
+                    changes.append(f"{collected_casualty}: {', '.join(changed_fields) or 'no data changes'}")
+                    metrics.increment("recollect_pages", result="changed")
+                casualty = _add_casualty(casualties, exist_names, collected_casualty)
                 new_urls_counter += 1
-                print(f"Data was collected from {new_urls_counter} URLs")
+                _log.info("Casualty data was collected", extra={"collected": new_urls_counter})
+                if not casualty.post_published:
+                    _set_main_image(casualty)
+                collected_data = casualty.to_dict()
             except Exception as e:
                 errors_urls_counter += 1
-                print(f"\nError while collecting data from {url}:\n{e}\n")
-    print(f"{len(urls) - new_urls_counter} URLs were already exists")
+                _log.error("Error while collecting data: %s", e)
+                if url_key in recollected:
+                    # Keep the previous data
+                    casualties.append(recollected[url_key])
+        # Yielded outside of the correlation, which must not leak into the consumer
+        if collected_data is not None:
+            yield collected_data
+    _log.info("URLs were already collected", extra={"existing": len(urls) - new_urls_counter})
+    if recollect:
+        unchanged = sum(url.replace("https://", "") in exist_urls for url in urls)
+        metrics.increment("recollect_pages", unchanged, result="unchanged")
+        metrics.increment("recollect_pages", new_urls_counter - len(changes), result="new")
+        _log.info(
+            "Recollected the casualties pages",
+            extra={"unchanged": unchanged, "changed": len(changes), "new": new_urls_counter - len(changes)},
+        )
+        for change in changes:
+            _log.info("Changed: %s", change)
     if errors_urls_counter:
-        print(f"An error occurred with {errors_urls_counter} other URLs")
-    print("\nLooking for additional images in external resources...")
+        _log.warning("An error occurred with other URLs", extra={"errors": errors_urls_counter})
+    _log.info("Looking for additional images in external resources")
     redownload = True
     for casualty in casualties:
         if not casualty.post_published:
-            print(f'casualty: {casualty}, instagram_user:{instagram_user}, intagram_password:{intagram_password}')
             redownload = False
-            if not casualty.post_main_image and casualty.post_additional_images:
-                casualty.post_main_image = casualty.post_additional_images[0]
-                casualty.post_additional_images = casualty.post_additional_images[1:]
-    print("\nDone!")
-    return [casualty.to_dict() for casualty in casualties]
\ No newline at end of file
+            _set_main_image(casualty)
+    _log.info("Casualties data was collected", extra={"casualties": len(casualties)})
+    return [casualty.to_dict() for casualty in casualties]
+
+def collect_casualties_data(
+        casualties_data: List[dict],
+        instagram_user: str,
+        intagram_password: str,
+        page_limit: int | None = None,
+        recollect: bool = False,
+        shard: Shard | None = None,
+) -> List[dict]:
+    """Collect casualties data from the IDF website"""
+    collector = iter_casualties_data(
+        casualties_data, instagram_user, intagram_password, page_limit, recollect, shard
+    )
+    while True:
+        try:
+            next(collector)
+        except StopIteration as stop:
+            return stop.value
+
+def merge_casualties_data(
+        casualties_data: List[dict], collected_data: List[dict]
+) -> List[dict]:
+    """
+    Merge casualties which were collected separately (e.g. by collect shards) into the data,
+    by the same identity rules of the collection: the URL (without its scheme), and then
+    the name, age and living city.
+    """
+    casualties: List[Casualty] = [
+        Casualty.from_dict(casualty_data) for casualty_data in casualties_data
+    ]
+    exist_urls = {
+        casualty.data_url.replace("https://", ""): casualty for casualty in casualties
+    }
+    exist_names = {casualty.full_name: casualty for casualty in casualties}
+    for casualty_data in collected_data:
+        casualty = Casualty.from_dict(casualty_data)
+        url_key = casualty.data_url.replace("https://", "")
+        if url_key in exist_urls:
+            exist_casualty = exist_urls[url_key]
+            if exist_casualty.post_published:
+                continue
+            # Recollected
+            casualties.remove(exist_casualty)
+            casualties.append(casualty)
+        else:
+            casualty = _add_casualty(casualties, exist_names, casualty)
+        exist_urls[url_key] = casualty
+        if not casualty.post_published:
+            _set_main_image(casualty)
+    return [casualty.to_dict() for casualty in casualties]
@@ -1,11 +1,20 @@
 import argparse
 import getpass
 import importlib
-from typing import Any, Optional, Sequence, Text, Union
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import Any, List, Optional, Sequence, Text, Union
 
-from utils.json_storage import reload_data, write_data
-from utils.build_posts import create_casualties_posts
-from utils.publish_posts import publish_casualties_posts
+from utils import logs, metrics
+from utils.json_storage import FORMATS, reload_data, set_data_format, write_data
+from utils.paths import METRICS_DIR
+from utils.shards import (
+    parse_shard,
+    select,
+    write_build_shard,
+    write_collect_shard,
+)
 
 
 class Password(argparse.Action):
@@ -22,6 +31,16 @@ class Password(argparse.Action):
         setattr(namespace, self.dest, values)
 
 
+def import_stage_module(stage: str, module_name: str) -> ModuleType:
+    """
+    Import the module only once its stage is about to run, so a run doesn't pay for the heavy
+    dependencies (selenium, instagrapi, instaloader, cv2, etc.) of stages it doesn't run.
+    The import time is measured per stage.
+    """
+    with metrics.timer("stage_import_seconds", stage=stage):
+        return importlib.import_module(module_name)
+
+
 def parse_args() -> argparse.Namespace:
     """Arguments handler"""
 
@@ -29,18 +48,22 @@ def parse_args() -> argparse.Namespace:
         prog="Insta Memorialization",
         description="Tool for publishing personal posts describing the war casualties",
     )
-    parser.add_argument(
+    func_arg = parser.add_argument(
         "-func",
         "--scrap_function_package",
         required=True,
+        nargs="+",
         help="""
-            Relative python package path, e.g. "iron_swords.scrap", that includes collect_casualties_data function
+            Relative python package path, e.g. "iron_swords.scrap", that includes collect_casualties_data function.
+            Several datasets can be given (in the same order as their JSON path packages), and their
+            stages run together in one process.
        """,
     )
     parser.add_argument(
         "-json",
         "--json_path_package",
         required=True,
+        nargs="+",
         help="""
             Relative python package path, e.g. "iron_swords.paths", that includes JSON_FILE path
         """,
@@ -62,7 +85,12 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--recollect",
         action="store_true",
-        help="Collect data about the casualties from the web, even if it was already collected, unless if it was already published",
+        help="Collect again the casualties whose pages were changed since they were collected, unless if they were already published",
+    )
+    offline_arg = parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Collect from the pages stored in the HTTP cache, without network traffic (e.g. with --recollect, for re-parsing the whole site)",
     )
     build_arg = parser.add_argument(
         "--build", action="store_true", help="Create and save the posts"
@@ -70,6 +98,14 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--publish", action="store_true", help="Publish the pre-saved posts"
     )
+    validate_arg = parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="""
+            Validate the posts of the whole publish backlog in parallel, without publishing them
+            (regardless of posts_limit). Their prepared images are reused by the publish.
+        """,
+    )
     parser.add_argument(
         "--dry_run",
         action="store_true",
@@ -88,7 +124,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--posts_limit",
         type=int,
-        help="Maximal number of posts to publish (if not given - all the pages will be published)",
+        help="Maximal number of posts to publish, per dataset (if not given - all the pages will be published)",
     )
     parser.add_argument(
         "--min_images",
@@ -98,51 +134,299 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--names", nargs="+", help="Publish posts only for these names", default=[]
     )
+    parser.add_argument(
+        "--face_detector",
+        choices=["cascades", "dnn"],
+        default="cascades",
+        help='Face detection engine: the Haar cascades chain, or the YuNet CNN detector with the cascades as a fallback ("dnn")',
+    )
+    parser.add_argument(
+        "--detection_max_side",
+        type=int,
+        default=0,
+        help="Detect faces over a copy of the image downscaled to this size, e.g. 800 (0 for the full resolution). Faster, but may find different faces.",
+    )
+    parser.add_argument(
+        "--adaptive_detection",
+        action="store_true",
+        help="Order (and prune) the face detection cascades by their hit statistics from previous runs, per images source, and add the statistics of this run",
+    )
+    parser.add_argument(
+        "--detection_passes",
+        type=int,
+        help="Maximal number of face detection cascades to try per image (if not given - all of them)",
+    )
+    parser.add_argument(
+        "--detection_refinement_passes",
+        type=int,
+        help="Maximal number of the most likely cascades to try in the full resolution, after an ambiguous result over the downscaled image (if not given - the whole chain)",
+    )
+    parser.add_argument(
+        "--detection_threads",
+        type=int,
+        default=0,
+        help="Run the face detection cascades of each image speculatively on this many threads (0 for one after the other)",
+    )
+    pipeline_arg = parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Run the stages as a streaming pipeline: each casualty is built and published as soon as it's collected",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=8,
+        help="Maximal number of casualties waiting between two stages of the pipeline",
+    )
+    shard_arg = parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="""
+            Collect or build only the i-th of N deterministic slices of the dataset (given as "i/N"), into a shard
+            directory, to be merged with "python -m utils.shards merge-collect" or "python -m utils.shards merge"
+        """,
+    )
+    parser.add_argument(
+        "--data_format",
+        choices=FORMATS,
+        default="json",
+        help="""
+            Format of the new data files ("orjson" and "msgpack" are much faster for large datasets).
+            Existing files keep their format, and are converted with "python -m utils.json_storage convert"
+        """,
+    )
+    parser.add_argument(
+        "--log_level",
+        choices=logs.LOG_LEVELS,
+        default="INFO",
+        help="Level of the structured log (DEBUG also logs the hot paths, e.g. every rendered text line)",
+    )
+    parser.add_argument(
+        "--log_file",
+        help="File for the structured log, written as JSON lines (if not given - it's written to stderr)",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=METRICS_DIR,
+        help="Directory for the run metrics (timings and counters), written as JSON and in Prometheus text format",
+    )
     args = parser.parse_args()
     if args.collect and args.publish and not args.build:
         raise argparse.ArgumentError(
             argument=build_arg,
             message='You cannot use "collect" and "publish" without "build"',
         )
+    if args.offline and not args.collect:
+        raise argparse.ArgumentError(
+            argument=offline_arg,
+            message='You cannot use "offline" without "collect"',
+        )
+    if args.pipeline and not args.collect:
+        raise argparse.ArgumentError(
+            argument=pipeline_arg,
+            message='You cannot use "pipeline" without "collect"',
+        )
+    if len(args.scrap_function_package) != len(args.json_path_package):
+        raise argparse.ArgumentError(
+            argument=func_arg,
+            message="Each dataset requires both a scrap function package and a JSON path package",
+        )
+    if args.pipeline and 1 < len(args.scrap_function_package):
+        raise argparse.ArgumentError(
+            argument=pipeline_arg,
+            message='You cannot use "pipeline" with several datasets',
+        )
+    if args.validate and (args.pipeline or args.shard):
+        raise argparse.ArgumentError(
+            argument=validate_arg,
+            message='You cannot use "validate" with "pipeline" or "shard"',
+        )
+    if args.shard and (args.publish or args.pipeline or args.collect == args.build):
+        raise argparse.ArgumentError(
+            argument=shard_arg,
+            message='You can use "shard" only with either "collect" or "build"',
+        )
     return args
 
 
+def collect_dataset(
+    args: argparse.Namespace,
+    scrap_function_package: str,
+    casualties_data: List[dict],
+    json_file: str,
+) -> List[dict]:
+    """
+    Run the collect stage of a single dataset, into its own JSON file
+    (or only its shard, into the shard directory)
+    """
+    with logs.span("collect_dataset", json_file=json_file):
+        return _collect_dataset(args, scrap_function_package, casualties_data, json_file)
+
+
+def _collect_dataset(
+    args: argparse.Namespace,
+    scrap_function_package: str,
+    casualties_data: List[dict],
+    json_file: str,
+) -> List[dict]:
+    scrap_module = import_stage_module("collect", scrap_function_package)
+    if args.shard:
+        collector = scrap_module.iter_casualties_data(
+            casualties_data,
+            args.instagram_username,
+            args.instagram_password,
+            args.pages_limit,
+            args.recollect,
+            args.shard,
+        )
+        write_collect_shard(json_file, args.shard, list(collector))
+        return casualties_data
+    casualties_data = scrap_module.collect_casualties_data(
+        casualties_data,
+        args.instagram_username,
+        args.instagram_password,
+        args.pages_limit,
+        args.recollect,
+    )
+    write_data(casualties_data, json_file)
+    return casualties_data
+
+
 if __name__ == "__main__":
     args = parse_args()
+    logs.configure(args.log_level, args.log_file)
+    set_data_format(args.data_format)
 
-    collect_casualties_data = importlib.import_module(
-        args.scrap_function_package
-    ).collect_casualties_data
-    JSON_FILE = importlib.import_module(args.json_path_package).JSON_FILE
+    JSON_FILES = [
+        importlib.import_module(json_path_package).JSON_FILE
+        for json_path_package in args.json_path_package
+    ]
 
     instagram_username = args.instagram_username
     instagram_password = args.instagram_password
 
-    casualties_data = reload_data(JSON_FILE)
+    datasets = [reload_data(json_file) for json_file in JSON_FILES]
 
-    if args.collect:
-        casualties_data = collect_casualties_data(
-            casualties_data,
-            instagram_username,
-            instagram_password,
-            args.pages_limit,
-            args.recollect,
+    if args.offline:
+        import_stage_module("collect", "utils.http_cache").HttpCache(offline=True)
+
+    # Only the validate and the publish stages detect faces (when the images are cropped for Instagram)
+    if args.validate or args.publish:
+        import_stage_module("images", "utils.images").set_face_detector(
+            args.face_detector,
+            args.detection_max_side,
+            args.adaptive_detection,
+            args.detection_passes,
+            args.detection_threads,
+            args.detection_refinement_passes,
         )
-        write_data(casualties_data, JSON_FILE)
 
-    if args.build:
-        casualties_data = create_casualties_posts(casualties_data)
-        write_data(casualties_data, JSON_FILE)
+    if args.pipeline:
+        iter_casualties_data = import_stage_module(
+            "collect", args.scrap_function_package[0]
+        ).iter_casualties_data
+        run_pipeline = import_stage_module("pipeline", "utils.pipeline").run_pipeline
+        publisher = None
+        if args.publish:
+            publisher = import_stage_module(
+                "publish", "utils.publish_posts"
+            ).CasualtiesPublisher(
+                instagram_username,
+                instagram_password,
+                args.posts_limit,
+                args.min_images,
+                args.names,
+                args.test,
+                args.dry_run,
+            )
+        with metrics.timer("stage_seconds", stage="pipeline"), logs.span("pipeline"):
+            datasets[0] = run_pipeline(
+                datasets[0],
+                JSON_FILES[0],
+                iter_casualties_data,
+                (instagram_username, instagram_password, args.pages_limit, args.recollect),
+                build=args.build,
+                publisher=publisher,
+                queue_size=args.queue_size,
+            )
 
-    if args.publish:
-        casualties_data = publish_casualties_posts(
-            casualties_data,
-            instagram_username,
-            instagram_password,
-            args.posts_limit,
-            args.min_images,
-            args.names,
-            args.test,
-            args.dry_run,
+    if args.collect and not args.pipeline:
+        # The datasets are collected concurrently (the scraping is mostly waiting for pages),
+        # sharing the external posts corpus and the Instagram session of the process.
+        # The shared caches are created before the threads, as the singletons creation isn't thread-safe
+        import_stage_module("collect", "utils.http_cache").HttpCache()
+        import_stage_module("collect", "utils.image_store").ImageStore()
+        with metrics.timer("stage_seconds", stage="collect"), logs.span("collect"):
+            with ThreadPoolExecutor(len(datasets)) as executor:
+                datasets = list(
+                    executor.map(
+                        collect_dataset,
+                        [args] * len(datasets),
+                        args.scrap_function_package,
+                        datasets,
+                        JSON_FILES,
+                    )
+                )
+
+    if args.build and not args.pipeline:
+        create_casualties_posts = import_stage_module(
+            "build", "utils.build_posts"
+        ).create_casualties_posts
+        with metrics.timer("stage_seconds", stage="build"), logs.span("build"):
+            inputs = [
+                select(dataset, args.shard) if args.shard else dataset
+                for dataset in datasets
+            ]
+            # The posts of all the datasets are created over a single processes pool
+            casualties_data = create_casualties_posts(
+                [casualty_data for dataset in inputs for casualty_data in dataset]
+            )
+            offset = 0
+            for i, json_file in enumerate(JSON_FILES):
+                built = casualties_data[offset : offset + len(inputs[i])]
+                offset += len(inputs[i])
+                if args.shard:
+                    write_build_shard(json_file, args.shard, inputs[i], built)
+                else:
+                    datasets[i] = built
+                    write_data(built, json_file)
+
+    if args.validate:
+        validate_casualties_posts = import_stage_module(
+            "publish", "utils.publish_posts"
+        ).validate_casualties_posts
+        with metrics.timer("stage_seconds", stage="validate"), logs.span("validate"):
+            # The posts of all the datasets are validated over a single processes pool
+            validation_report = validate_casualties_posts(
+                [casualty_data for dataset in datasets for casualty_data in dataset],
+                args.min_images,
+                args.names,
+                args.test,
+            )
+
+    if args.publish and not args.pipeline:
+        publish_casualties_posts = import_stage_module(
+            "publish", "utils.publish_posts"
+        ).publish_casualties_posts
+        with metrics.timer("stage_seconds", stage="publish"), logs.span("publish"):
+            for i, json_file in enumerate(JSON_FILES):
+                datasets[i] = publish_casualties_posts(
+                    datasets[i],
+                    instagram_username,
+                    instagram_password,
+                    args.posts_limit,
+                    args.min_images,
+                    args.names,
+                    args.test,
+                    args.dry_run,
+                )
+                write_data(datasets[i], json_file)
+
+    if args.adaptive_detection and (args.validate or args.publish):
+        import_stage_module("images", "utils.face_detectors").save_statistics(
+            metrics.REGISTRY.snapshot()
         )
-        write_data(casualties_data, JSON_FILE)
+    metrics.export(args.metrics)
+    if args.validate and validation_report["summary"]["failed_posts"]:
+        # The other stages run anyway, but a failed validation fails the run
+        sys.exit(1)
@@ -0,0 +1,48 @@
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from utils.face_detectors import CascadeChainDetector
+
+RESOURCES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources")
+
+
+@pytest.fixture(scope="module")
+def images():
+    paths = sorted(
+        glob.glob(os.path.join(RESOURCES_DIR, "*.jpg"))
+        + glob.glob(os.path.join(RESOURCES_DIR, "*.jpeg"))
+        + glob.glob(os.path.join(RESOURCES_DIR, "*.png"))
+    )
+    loaded = [cv2.imread(path) for path in paths]
+    return [img for img in loaded if img is not None]
+
+
+def _rectangles(faces):
+    return [tuple(face[:4]) for face in faces]
+
+
+@pytest.mark.parametrize("concurrency", [2, 4, 11])
+def test_speculative_detection_matches_sequential(images, concurrency):
+    sequential = CascadeChainDetector(concurrency=0)
+    expected = [_rectangles(sequential.detect(img)) for img in images]
+
+    speculative = CascadeChainDetector(concurrency=concurrency)
+    assert [_rectangles(speculative.detect(img)) for img in images] == expected
+    # Several threads detect at once too, over the same detector (and the same cascades)
+    with ThreadPoolExecutor(4) as executor:
+        for _ in range(3):
+            assert [
+                _rectangles(faces) for faces in executor.map(speculative.detect, images)
+            ] == expected
+
+
+def test_grayscale_detection_matches_color(images):
+    detector = CascadeChainDetector()
+    for img in images:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        assert _rectangles(detector.detect(gray)) == _rectangles(detector.detect(img))
@@ -0,0 +1,109 @@
+import os
+import time
+
+import pytest
+
+from utils.work_queue import (
+    DONE,
+    FAILED,
+    LEASED,
+    PENDING,
+    MemoryWorkQueue,
+    SqliteWorkQueue,
+    work,
+)
+
+LEASE_SECONDS = 0.2
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_queue(request, tmp_path):
+    def make_queue(max_attempts: int = 3):
+        if request.param == "memory":
+            return MemoryWorkQueue(LEASE_SECONDS, max_attempts)
+        return SqliteWorkQueue(os.path.join(tmp_path, "work_queue.db"), LEASE_SECONDS, max_attempts)
+
+    return make_queue
+
+
+def test_lease_expiry(make_queue):
+    queue = make_queue()
+    queue.put("build", "a", {"name": "a"})
+    first = queue.lease("build", "first")
+    assert first.payload == {"name": "a"} and first.attempts == 1
+    assert queue.lease("build", "second") is None
+    assert queue.progress("build") == {LEASED: 1}
+
+    time.sleep(LEASE_SECONDS * 1.5)
+    second = queue.lease("build", "second")
+    assert second.id == first.id and second.attempts == 2
+    # The result of the worker whose lease expired is dropped
+    assert not queue.complete(first, "stale")
+    assert queue.complete(second, "fresh")
+    assert queue.results("build") == {"a": "fresh"}
+    assert not queue.unfinished("build")
+
+
+def test_max_attempts(make_queue):
+    queue = make_queue(max_attempts=2)
+    queue.put("build", "a", {"name": "a"})
+    queue.fail(queue.lease("build", "worker"), "first error")
+    assert queue.progress("build") == {PENDING: 1}
+    task = queue.lease("build", "worker")
+    assert task.attempts == 2
+    queue.fail(task, "second error")
+    assert queue.progress("build") == {FAILED: 1}
+    assert queue.lease("build", "worker") is None
+
+
+def test_expired_lease_of_last_attempt_fails(make_queue):
+    queue = make_queue(max_attempts=1)
+    queue.put("build", "a", {"name": "a"})
+    assert queue.lease("build", "worker") is not None
+    time.sleep(LEASE_SECONDS * 1.5)
+    assert queue.lease("build", "worker") is None
+    assert queue.progress("build") == {FAILED: 1}
+
+
+def test_put_keeps_existing_task(make_queue):
+    queue = make_queue()
+    queue.put("build", "a", {"name": "a"})
+    queue.put("build", "b", {"name": "b"})
+    task = queue.lease("build", "worker")
+    queue.complete(task, "built")
+
+    # The applied result changes the record, which must not enqueue it again
+    queue.put("build", "a", {"name": "a", "post_path": "built"})
+    assert queue.progress("build") == {DONE: 1, PENDING: 1}
+    assert queue.results("build") == {"a": "built"}
+    assert queue.payloads("build")["a"] == {"name": "a"}
+
+
+def test_put_reset(make_queue):
+    queue = make_queue()
+    queue.put("build", "a", {"name": "a"})
+    queue.complete(queue.lease("build", "worker"), "built")
+
+    queue.put("build", "a", {"name": "a", "changed": True}, reset=True)
+    assert queue.progress("build") == {PENDING: 1}
+    assert queue.results("build") == {}
+    assert queue.payloads("build")["a"] == {"name": "a", "changed": True}
+    task = queue.lease("build", "worker")
+    assert task.key == "a" and task.attempts == 1
+
+
+def test_work_retries_failed_tasks(make_queue):
+    queue = make_queue()
+    for key in ["a", "b"]:
+        queue.put("build", key, {"name": key})
+    calls = []
+
+    def handler(payload):
+        calls.append(payload["name"])
+        if calls.count(payload["name"]) == 1 and payload["name"] == "a":
+            raise ValueError("first attempt")
+        return payload["name"].upper()
+
+    assert work(queue, "build", handler, "worker", poll_seconds=0) == 2
+    assert queue.results("build") == {"a": "A", "b": "B"}
+    assert calls.count("a") == 2
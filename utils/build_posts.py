@@ -220,19 +220,22 @@ from typing import List
 from pathlib import Path
 from PIL import Image, ImageFont, ImageDraw
 
+from utils import logs, metrics
 from utils.casualty import Casualty, Gender
 from utils.paths import *
 
+_log = logs.get_logger(__name__)
+
 def get_font(size: int):
-    print(f'in get_font function')
     """Generated a font object with the required size"""
+    _log.debug("Loading font", extra={"size": size})
     return ImageFont.truetype(
         "resources/Rubik-Regular.ttf", size, layout_engine=ImageFont.Layout.RAQM
     )
 
 def _get_background(casualty: Casualty):
-    print(f'in _get_background function')
     """Return a background image, matching the casualty's gender"""
+    _log.debug("Choosing background", extra={"gender": casualty.gender})
     backgrounds = {
         Gender.FEMALE: "resources/female.png",
         Gender.MALE: "resources/male.png",
@@ -257,7 +260,6 @@ def _get_background(casualty: Casualty):
 #     casualty_img = casualty_img.resize((wanted_width, int(wanted_width * ratio)))
 #     return casualty_img
 def _get_image(casualty: Casualty) -> Image:
-    print('in _get_image function')
     """Return the casualty's image, opened and resized"""
     image_path = casualty.post_main_image if casualty.post_main_image else "resources/no_image_default.jpeg"
     if image_path != "resources/no_image_default.jpeg":
@@ -273,7 +275,7 @@ def _get_image(casualty: Casualty) -> Image:
     try:
         casualty_img = Image.open(image_path)
     except FileNotFoundError:
-        print(f"Image not found: {image_path}, using default")
+        _log.warning("Image not found, using default", extra={"image_path": image_path})
         casualty_img = Image.open("resources/no_image_default.jpeg")
     width, height = casualty_img.size
     ratio = height / width
@@ -374,9 +376,14 @@ def _get_post_path(casualty: Casualty) -> str:
     post_path = f"{post_dir}/{sanitized_name}.jpg"
     return post_path
 
+@metrics.timed("create_casualty_post_seconds")
 def create_casualty_post_worker(casualty_data: dict) -> dict:
     """Create the casualty's post and save it"""
     casualty: Casualty = Casualty.from_dict(casualty_data)
+    with logs.correlation(casualty.data_url):
+        return _create_casualty_post(casualty).to_dict()
+
+def _create_casualty_post(casualty: Casualty) -> Casualty:
     try:
         if not casualty.post_published:
             background = _get_background(casualty)
@@ -392,15 +399,17 @@ def create_casualty_post_worker(casualty_data: dict) -> dict:
                 draw, y_axis_offset = _add_details(casualty, draw, y_axis_offset)
                 casualty.post_path = _get_post_path(casualty)
                 post.convert("RGB").save(casualty.post_path)
-    except Exception as e:
-        print(f"Failed to generate post for {casualty}: {e}")
-    finally:
-        return casualty.to_dict()
+                _log.debug("Post was created", extra={"post_path": casualty.post_path})
+    except Exception:
+        _log.exception("Failed to generate post for %s", casualty)
+    return casualty
 
 def create_casualties_posts(given_casualties_data: List[dict]) -> List[dict]:
     """Create post for all the casualties and save it"""
-    process_pool = multiprocessing.Pool()
-    updated_casualties_data = process_pool.map(create_casualty_post_worker, given_casualties_data)
+    process_pool = multiprocessing.Pool(
+        initializer=logs.worker_initializer, initargs=logs.worker_initargs()
+    )
+    updated_casualties_data = metrics.pool_map(process_pool, create_casualty_post_worker, given_casualties_data)
     process_pool.close()
     return updated_casualties_data
 
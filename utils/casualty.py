@@ -33,6 +33,7 @@ class Casualty:
     post_caption: str | None = None
     post_tested: bool | str = False
     post_published: bool | str = False
+    page_fingerprint: str | None = None  # Of the casualty page, for detecting its changes
 
     def __str__(self) -> str:
         return f'"{self.full_name}"'
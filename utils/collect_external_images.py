@@ -1,19 +1,99 @@
 import os
-from typing import List
-from utils.paths import EXTERNAL_IMAGES_DIR, is_image_file
+from typing import Dict, List, Set
+
+from utils.json_storage import reload_data, write_data
+from utils.paths import EXTERNAL_IMAGES_DIR, EXTERNAL_IMAGES_INDEX_FILE, has_image_suffix
+
+
+TRIGRAM_LENGTH = 3
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i : i + TRIGRAM_LENGTH] for i in range(len(text) - TRIGRAM_LENGTH + 1)}
+
+
+class ExternalImagesIndex:
+    """
+    Index from the trigrams (3 characters substrings) of the file names to the paths of the images
+    in the external images pool. It only narrows the candidates of a name, which are then matched
+    by the same substring test as the full scan (the file name contains the name, as is),
+    so a name also matches inside a longer word (e.g. "נדב כהן1.jpg").
+    The directories listings are persisted along with their modification times,
+    so only directories which were changed since the previous run are scanned again.
+    """
+
+    def __init__(self, path: str, index_file: str = EXTERNAL_IMAGES_INDEX_FILE) -> None:
+        self.path = path
+        self.index_file = index_file
+        stored_index = reload_data(index_file) or {}
+        self._dirs: Dict[str, dict] = (
+            stored_index.get("dirs", {}) if stored_index.get("path") == path else {}
+        )
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._paths: List[str] = []
+
+    def _scan(self, path: str, dirs: Dict[str, dict]) -> bool:
+        """Scan the directory (if changed) and its sub directories. Return whether anything was changed."""
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            if path == self.path:
+                raise  # A missing pool is an error, as in the full scan
+            return False  # A sub directory which was removed while scanning
+        changed = False
+        listing = self._dirs.get(path)
+        if not listing or listing["mtime"] != mtime:
+            listing = {"mtime": mtime, "images": [], "subdirs": []}
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        listing["subdirs"].append(entry.name)
+                    elif entry.is_file() and has_image_suffix(entry.name):
+                        listing["images"].append(entry.name)
+            changed = True
+        dirs[path] = listing
+        for subdir in listing["subdirs"]:
+            changed |= self._scan(os.path.join(path, subdir), dirs)
+        return changed
+
+    def refresh(self) -> None:
+        """Rescan the changed directories and rebuild the index"""
+        dirs = {}
+        changed = self._scan(self.path, dirs)
+        if changed or dirs.keys() != self._dirs.keys():
+            self._dirs = dirs
+            write_data({"path": self.path, "dirs": self._dirs}, self.index_file)
+        self._trigrams = {}
+        self._paths = []
+        for dir_path, listing in self._dirs.items():
+            for file_name in listing["images"]:
+                file_path = os.path.join(dir_path, file_name)
+                self._paths.append(file_path)
+                for trigram in _trigrams(file_name):
+                    self._trigrams.setdefault(trigram, set()).add(file_path)
+
+    def find(self, full_name: str) -> List[str]:
+        """Return the paths of all the images whose file name contains the given name"""
+        trigrams = _trigrams(full_name)
+        if trigrams:
+            candidates = set.intersection(
+                *[self._trigrams.get(trigram, set()) for trigram in trigrams]
+            )
+        else:
+            candidates = self._paths  # A name too short to narrow down
+        return sorted(
+            path for path in candidates if full_name in os.path.basename(path)
+        )
+
+
+_INDEXES: Dict[str, ExternalImagesIndex] = {}
 
 
 def find_images_in_external_images_pool(
     full_name: str, path: str = os.path.join(os.getcwd(), EXTERNAL_IMAGES_DIR)
 ) -> List[str]:
     """Collect the paths of all the images in the pool matching the given name"""
-    images_paths = []
-    for file_name in os.listdir(path):
-        file_path = os.path.join(path, file_name)
-        if is_image_file(file_path) and full_name in file_name:
-            images_paths.append(file_path)
-        elif os.path.isdir(file_path):
-            images_paths.extend(
-                find_images_in_external_images_pool(full_name, file_path)
-            )
-    return images_paths
+    if path not in _INDEXES:
+        _INDEXES[path] = ExternalImagesIndex(path)
+        _INDEXES[path].refresh()
+    return _INDEXES[path].find(full_name)
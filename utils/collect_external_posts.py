@@ -1,67 +1,184 @@
-from functools import reduce
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import os
-from typing import List
+import sys
+import threading
+from typing import Dict, List
 
+from singleton_decorator import singleton
+
+from utils import logs
 from utils.instagram import InstagramScraper, PostContent
 from utils.json_storage import reload_data, write_data
+from utils.name_matcher import match_names
 from utils.paths import EXTERNAL_POSTS_DIR
 
+_log = logs.get_logger(__name__)
 
-def _download_external_posts(
-    instagram_accounts: List[str],
-    instagram_user: str,
-    intagram_password: str,
-    redownload: bool = True,
-) -> List[PostContent]:
-    """Download posts from other Instagram accounts, in order to look for additional related images"""
-    external_posts = []
-    for account in instagram_accounts:
-        target_dir = f"{EXTERNAL_POSTS_DIR}/{account}"
-        json_path = f"{target_dir}/{account}.json"
-        account_posts = []
-        # Posts that were already download
-        if os.path.isfile(json_path):
-            account_posts_data = reload_data(json_path)
-            account_posts.extend(
-                [PostContent.from_dict(post_data) for post_data in account_posts_data]
-            )
-        # New posts
-        if redownload or not account_posts:
-            print(f'Looking for new posts in the instagram page "{account}"')
-            new_account_posts = InstagramScraper(
-                instagram_user, intagram_password
-            ).download_posts(
+_SCRAPER_LOCK = threading.Lock()
+_CORPUS_LOCK = threading.Lock()
+
+
+def _get_scraper(instagram_user: str, intagram_password: str) -> InstagramScraper:
+    """Return the (single) scraper, safely from any of the accounts threads"""
+    with _SCRAPER_LOCK:
+        return InstagramScraper(instagram_user, intagram_password)
+
+
+def _compact(post: PostContent) -> PostContent:
+    """Intern the post strings, so repeated captions and paths are kept in memory only once"""
+    post.text = sys.intern(post.text)
+    post.images_paths = [sys.intern(path) for path in post.images_paths]
+    return post
+
+
+@singleton
+class ExternalPostsCorpus:
+    """
+    In-memory corpus of the posts of other Instagram accounts.
+    Each account is loaded (and synced, if required) only once per process,
+    and its new posts are appended to the corpus as they are synced.
+    """
+
+    def __init__(self, instagram_user: str, intagram_password: str) -> None:
+        self.instagram_user = instagram_user
+        self.intagram_password = intagram_password
+        self._posts: Dict[str, List[PostContent]] = {}
+        self._accounts_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+    @staticmethod
+    def _target_dir(account: str) -> str:
+        return f"{EXTERNAL_POSTS_DIR}/{account}"
+
+    @classmethod
+    def _json_path(cls, account: str) -> str:
+        return f"{cls._target_dir(account)}/{account}.json"
+
+    def _scraper(self) -> InstagramScraper:
+        return _get_scraper(self.instagram_user, self.intagram_password)
+
+    def _save(self, account: str) -> None:
+        """Save the account posts"""
+        write_data(
+            [post.to_dict() for post in self._posts[account]], self._json_path(account)
+        )
+
+    def _load(self, account: str) -> None:
+        """Load the posts that were already synced"""
+        json_path = self._json_path(account)
+        self._posts[account] = (
+            [
+                _compact(PostContent.from_dict(post_data))
+                for post_data in reload_data(json_path)
+            ]
+            if os.path.isfile(json_path)
+            else []
+        )
+
+    def _sync(self, account: str) -> None:
+        """Sync the new posts of the account (captions only)"""
+        _log.info("Looking for new posts in the instagram page", extra={"account": account})
+        account_posts = self._posts[account]
+        known_shortcodes = {post.shortcode for post in account_posts}
+        new_account_posts = [
+            _compact(post)
+            for post in self._scraper().sync_posts(
                 account,
-                target_dir,
+                self._target_dir(account),
                 starting_date=(
                     max([post.date for post in account_posts])
                     if account_posts
                     else None
                 ),
             )
-            print(f"{len(new_account_posts)} posts were download from {account}")
-            account_posts.extend(new_account_posts)
-            account_posts_data = [post.to_dict() for post in account_posts]
-            write_data(account_posts_data, json_path)
-        external_posts.extend(account_posts)
+            if post.shortcode is None or post.shortcode not in known_shortcodes
+        ]
+        _log.info("Posts were synced", extra={"account": account, "posts": len(new_account_posts)})
+        account_posts.extend(new_account_posts)
+        self._save(account)
+
+    def _download_media(
+        self, account: str, posts: List[PostContent]
+    ) -> Dict[str, PostContent]:
+        """Download the images of the given posts of the account, update the corpus and return the updated posts"""
+        downloaded_posts = {
+            post.shortcode: _compact(post)
+            for post in self._scraper().download_media(
+                account, self._target_dir(account), posts
+            )
+        }
+        _log.info("Posts images were downloaded", extra={"account": account, "posts": len(downloaded_posts)})
+        self._posts[account] = [
+            downloaded_posts.get(post.shortcode, post) for post in self._posts[account]
+        ]
+        self._save(account)
+        return downloaded_posts
 
-    return external_posts
+    def account_posts(self, account: str, redownload: bool = True) -> List[PostContent]:
+        """Return the posts of the account. On the first call, new posts are synced if required."""
+        with self._accounts_locks[account]:
+            if account not in self._posts:
+                self._load(account)
+                if redownload or not self._posts[account]:
+                    self._sync(account)
+            return self._posts[account]
+
+    def _find_names(
+        self, account: str, full_names: List[str], redownload: bool = True
+    ) -> Dict[str, List[PostContent]]:
+        """Find the account posts mentioning each of the names, and make sure their images were downloaded"""
+        names_posts = match_names(full_names, self.account_posts(account, redownload))
+        with self._accounts_locks[account]:
+            missing_media_posts = {
+                post.shortcode: post
+                for posts in names_posts.values()
+                for post in posts
+                if not post.media_downloaded
+            }
+            if missing_media_posts:
+                downloaded_posts = self._download_media(
+                    account, list(missing_media_posts.values())
+                )
+                names_posts = {
+                    full_name: [downloaded_posts.get(post.shortcode, post) for post in posts]
+                    for full_name, posts in names_posts.items()
+                }
+        return names_posts
+
+    def find_images_by_names(
+        self,
+        full_names: List[str],
+        instagram_accounts: List[str],
+        redownload: bool = True,
+    ) -> Dict[str, List[str]]:
+        """Find posts with each of the given names and return the images they contain, per name"""
+        with ThreadPoolExecutor(max_workers=max(1, len(instagram_accounts))) as pool:
+            accounts_names_posts = list(
+                pool.map(
+                    lambda account: self._find_names(account, full_names, redownload),
+                    instagram_accounts,
+                )
+            )
+        names_images = {full_name: [] for full_name in full_names}
+        for names_posts in accounts_names_posts:
+            for full_name, posts in names_posts.items():
+                for post in posts:
+                    names_images[full_name].extend(post.images_paths)
+        return names_images
 
 
-def find_images_in_external_posts(
-    full_name: str,
+def find_images_in_external_posts_by_names(
+    full_names: List[str],
     instagram_accounts: List[str],
     instagram_user: str,
     intagram_password: str,
     redownload: bool = True,
-) -> List[str]:
-    """Find posts with the given name and return list of all the images it contains"""
-    external_posts = _download_external_posts(
-        instagram_accounts, instagram_user, intagram_password, redownload
-    )
-    images_paths = reduce(
-        lambda a, b: a + b,
-        [post.images_paths for post in external_posts if full_name in post.text],
-        [],
-    )
-    return images_paths
+) -> Dict[str, List[str]]:
+    """
+    Find posts with each of the given names and return the images they contain, per name.
+    Every caption is scanned only once, for all the names together, so look for all the names at once.
+    """
+    # The corpus is created safely from any of the datasets threads
+    with _CORPUS_LOCK:
+        corpus = ExternalPostsCorpus(instagram_user, intagram_password)
+    return corpus.find_images_by_names(full_names, instagram_accounts, redownload)
@@ -0,0 +1,371 @@
+import abc
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple
+
+import cv2
+import numpy as np
+
+from utils import metrics
+from utils.image_store import DATASET_SOURCE, ImageStore
+from utils.json_storage import reload_data, write_data
+from utils.paths import FACE_DETECTION_STATISTICS_FILE
+
+FACE_DETECTION_DIR = os.path.join("utils", "face_detection")
+YUNET_MODEL_FILE = "face_detection_yunet_2023mar.onnx"
+YUNET_MODEL_URL = (
+    "https://github.com/opencv/opencv_zoo/raw/main/models/face_detection_yunet/" + YUNET_MODEL_FILE
+)
+
+CASCADES = [
+    "opencv_frontalface_detection",
+    "haarcascade_frontalface_default",
+    "haarcascade_frontalface_alt",
+    "haarcascade_frontalface_alt2",
+    "haarcascade_frontalface_alt_tree",
+    "haarcascade_profileface_detection",
+    "haarcascade_mcs_eyepair_big",
+    "haarcascade_mcs_eyepair_small",
+    "haarcascade_smile",
+    "haarcascade_mcs_nose",
+    "haarcascade_mcs_mouth",
+]
+
+
+class ScoredFace(NamedTuple):
+    """A detected face rectangle, with the confidence of the detector (in its own scale)"""
+
+    left: int
+    top: int
+    width: int
+    height: int
+    score: float
+
+
+class FaceDetector(abc.ABC):
+    """
+    A face detection engine, which runs over a decoded (BGR) image, or a grayscale one if the engine
+    is grayscale (i.e. it converts the image to grayscale anyway).
+    The source of the image (see image_source) lets the engine adapt to the kind of images.
+    """
+
+    name = ""
+    grayscale = False
+
+    @abc.abstractmethod
+    def detect(self, img: np.ndarray, source: str = "") -> List[ScoredFace]:
+        """The faces found in the image"""
+
+    def refine(
+        self, img: np.ndarray, source: str = "", passes: int | None = None
+    ) -> List[ScoredFace]:
+        """
+        Detect again (e.g. in a higher resolution, after an ambiguous result), with up to the given
+        number of passes (all of them if None). The refinement passes are not counted in the statistics.
+        """
+        return self.detect(img, source)
+
+
+def image_source(path: str) -> str:
+    """
+    The kind of the image, as recorded by the image store when it was added
+    (the records images are all blobs, so their directory doesn't tell)
+    """
+    return ImageStore().source(path) or DATASET_SOURCE
+
+
+class CascadeStatistics:
+    """
+    How many times each cascade was tried, and found exactly one face, per images source.
+    The statistics are collected as metrics (so they are merged from the worker processes too)
+    and are accumulated across runs in a file.
+    """
+
+    # A cascade which was tried at least PRUNE_MIN_TRIES times, and hit less than
+    # PRUNE_MAX_HIT_RATE of them, is dropped from the chain of its source
+    PRUNE_MIN_TRIES = 200
+    PRUNE_MAX_HIT_RATE = 0.005
+
+    def __init__(self, path: str = FACE_DETECTION_STATISTICS_FILE) -> None:
+        self.path = path
+        self.statistics: Dict[str, Dict[str, Dict[str, int]]] = reload_data(path) or {}
+
+    def order(self, source: str, cascades: List[str]) -> List[str]:
+        """
+        The cascades, from the most likely to hit to the least likely, without the pruned ones.
+        The hit rates are smoothed (Laplace), so an untried cascade is ranked by an even 0.5 hit rate,
+        before the tried cascades which hit less often, and the ties keep their original order.
+        """
+        source_statistics = self.statistics.get(source, {})
+        rates = {}
+        for cascade in cascades:
+            cascade_statistics = source_statistics.get(cascade, {"tries": 0, "hits": 0})
+            tries, hits = cascade_statistics["tries"], cascade_statistics["hits"]
+            if self.PRUNE_MIN_TRIES <= tries and hits / tries < self.PRUNE_MAX_HIT_RATE:
+                continue
+            rates[cascade] = (hits + 1) / (tries + 2)
+        if not rates:
+            return cascades
+        return sorted(rates, key=lambda cascade: -rates[cascade])
+
+    def update(self, snapshot: dict) -> None:
+        """Add the cascades passes and hits of the given metrics snapshot"""
+        for counter in snapshot["counters"]:
+            field = {"detect_faces_passes": "tries", "detect_faces_cascade_hits": "hits"}.get(
+                counter["name"]
+            )
+            labels = counter["labels"]
+            if field and labels.get("cascade") in CASCADES:
+                cascade_statistics = self.statistics.setdefault(
+                    labels.get("source", ""), {}
+                ).setdefault(labels["cascade"], {"tries": 0, "hits": 0})
+                cascade_statistics[field] += int(counter["value"])
+
+    def save(self) -> None:
+        write_data(self.statistics, self.path)
+
+
+_thread_local = threading.local()
+
+
+def load_cascade(cascade: str) -> cv2.CascadeClassifier:
+    """
+    Load the cascade once per thread, instead of once per detection.
+    A classifier keeps the state of the image it runs over, so it can't be shared between threads.
+    """
+    cascades = _thread_local.__dict__.setdefault("cascades", {})
+    if cascade not in cascades:
+        cascades[cascade] = cv2.CascadeClassifier(
+            os.path.join(FACE_DETECTION_DIR, f"{cascade}.xml")
+        )
+    return cascades[cascade]
+
+
+class CascadeChainDetector(FaceDetector):
+    """
+    The Haar cascades, tried one after the other, until one of them finds exactly one face.
+    The score of a face is the number of neighbour detections that were grouped into it.
+    With statistics, the chain of each images source is ordered by the cascades hit rates
+    (and the hopeless cascades are pruned), and max_passes limits the cascades tried per image.
+    With concurrency, the cascades of the chain run speculatively on that many threads
+    (OpenCV releases the GIL), and the result is the same as of the sequential chain.
+    """
+
+    name = "cascades"
+    grayscale = True
+
+    def __init__(
+        self,
+        cascades: List[str] = CASCADES,
+        statistics: CascadeStatistics | None = None,
+        max_passes: int | None = None,
+        concurrency: int = 0,
+    ) -> None:
+        self.cascades = cascades
+        self.statistics = statistics
+        self.max_passes = max_passes
+        self.concurrency = concurrency
+        self._chains: Dict[str, List[str]] = {}
+        self._executor: ThreadPoolExecutor | None = None
+        self._executor_pid: int | None = None
+
+    def chain(self, source: str) -> List[str]:
+        if source not in self._chains:
+            chain = self.cascades
+            if self.statistics:
+                chain = self.statistics.order(source, chain)
+            self._chains[source] = chain[: self.max_passes]
+        return self._chains[source]
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # A forked process doesn't inherit the threads of its parent, so it needs its own executor
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix="cascades"
+            )
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    @staticmethod
+    def _run_cascade(cascade: str, gray: np.ndarray) -> List[ScoredFace]:
+        rects, neighbours = load_cascade(cascade).detectMultiScale2(gray, 1.1, 4)
+        return [
+            ScoredFace(*(int(value) for value in rect), float(score))
+            for rect, score in zip(rects, neighbours)
+        ]
+
+    def detect(self, img: np.ndarray, source: str = "") -> List[ScoredFace]:
+        faces = []
+        succeeded_cascade = "none"
+        # The cascades run over grayscale, so convert once instead of once per cascade
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        chain = self.chain(source)
+        if 1 < self.concurrency and 1 < len(chain):
+            futures = [
+                self.executor.submit(self._run_cascade, cascade, gray) for cascade in chain
+            ]
+            results = (future.result() for future in futures)
+        else:
+            futures = []
+            results = (self._run_cascade(cascade, gray) for cascade in chain)
+        # The results are taken by the chain order, so the first single face hit wins
+        for i, (cascade, faces) in enumerate(zip(chain, results)):
+            metrics.increment("detect_faces_passes", cascade=cascade, source=source)
+            if len(faces) == 1:
+                succeeded_cascade = cascade
+                for future in futures[i + 1 :]:
+                    if not future.cancel():
+                        metrics.increment("detect_faces_speculative_passes", source=source)
+                break
+        metrics.increment("detect_faces_cascade_hits", cascade=succeeded_cascade, source=source)
+        return faces
+
+    def refine(
+        self, img: np.ndarray, source: str = "", passes: int | None = None
+    ) -> List[ScoredFace]:
+        faces = []
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # The most likely cascades (the first of the chain)
+        for cascade in self.chain(source)[:passes]:
+            metrics.increment("detect_faces_refinement_passes", cascade=cascade, source=source)
+            faces = self._run_cascade(cascade, gray)
+            if len(faces) == 1:
+                break
+        return faces
+
+
+class YuNetDetector(FaceDetector):
+    """
+    OpenCV's YuNet CNN face detector (cv2.FaceDetectorYN), which finds all the faces
+    of the image in a single pass, on CPU.
+    The model file is expected in the face detection directory, next to the cascades.
+    """
+
+    name = "yunet"
+
+    def __init__(
+        self,
+        model_path: str = os.path.join(FACE_DETECTION_DIR, YUNET_MODEL_FILE),
+        score_threshold: float = 0.8,
+        nms_threshold: float = 0.3,
+    ) -> None:
+        if not os.path.isfile(model_path):
+            raise FileNotFoundError(
+                f"The YuNet model file {model_path} is missing. "
+                'Download it with "python -m utils.face_detectors download"'
+            )
+        self.model_path = model_path
+        self.score_threshold = score_threshold
+        self.nms_threshold = nms_threshold
+        self._local = threading.local()
+
+    @property
+    def _detector(self):
+        # The input size is set on the model per image, so each thread has its own model
+        if not hasattr(self._local, "detector"):
+            self._local.detector = cv2.FaceDetectorYN.create(
+                self.model_path, "", (320, 320), self.score_threshold, self.nms_threshold
+            )
+        return self._local.detector
+
+    def detect(self, img: np.ndarray, source: str = "") -> List[ScoredFace]:
+        metrics.increment("detect_faces_passes", cascade=self.name, source=source)
+        return self._detect(img)
+
+    def refine(
+        self, img: np.ndarray, source: str = "", passes: int | None = None
+    ) -> List[ScoredFace]:
+        metrics.increment("detect_faces_refinement_passes", cascade=self.name, source=source)
+        return self._detect(img)
+
+    def _detect(self, img: np.ndarray) -> List[ScoredFace]:
+        height, width = img.shape[:2]
+        detector = self._detector
+        detector.setInputSize((width, height))
+        _, detections = detector.detect(img)
+        if detections is None:
+            return []
+        # Each detection is the box, 5 landmarks (x, y) and the score
+        return [
+            ScoredFace(*(round(float(value)) for value in detection[:4]), float(detection[-1]))
+            for detection in detections
+        ]
+
+
+class FallbackDetector(FaceDetector):
+    """Use the first detector, and fall back to the next ones while exactly one face wasn't found"""
+
+    def __init__(self, *detectors: FaceDetector) -> None:
+        self.detectors = detectors
+        self.name = "+".join(detector.name for detector in detectors)
+        self.grayscale = all(detector.grayscale for detector in detectors)
+
+    def detect(self, img: np.ndarray, source: str = "") -> List[ScoredFace]:
+        faces = []
+        for detector in self.detectors:
+            faces = detector.detect(img, source)
+            if len(faces) == 1:
+                metrics.increment("detect_faces_engine_hits", engine=detector.name)
+                break
+        return faces
+
+    def refine(
+        self, img: np.ndarray, source: str = "", passes: int | None = None
+    ) -> List[ScoredFace]:
+        faces = []
+        for detector in self.detectors:
+            faces = detector.refine(img, source, passes)
+            if len(faces) == 1:
+                break
+        return faces
+
+
+def _dnn_detector(**cascades_options) -> FaceDetector:
+    # Fails if the model is missing, rather than silently running the cascades only
+    return FallbackDetector(YuNetDetector(), CascadeChainDetector(**cascades_options))
+
+
+ENGINES: Dict[str, Callable[..., FaceDetector]] = {
+    "cascades": CascadeChainDetector,
+    "dnn": _dnn_detector,
+}
+
+
+def create_detector(
+    engine: str,
+    adaptive: bool = False,
+    max_passes: int | None = None,
+    concurrency: int = 0,
+) -> FaceDetector:
+    """Create the engine. If adaptive, the cascades chain is ordered by the saved statistics."""
+    statistics = CascadeStatistics() if adaptive else None
+    return ENGINES[engine](
+        statistics=statistics, max_passes=max_passes, concurrency=concurrency
+    )
+
+
+def save_statistics(snapshot: dict) -> None:
+    """Accumulate the cascades statistics of the run (in the given metrics snapshot) in the statistics file"""
+    statistics = CascadeStatistics()
+    statistics.update(snapshot)
+    statistics.save()
+
+
+def download_yunet_model(model_path: str = os.path.join(FACE_DETECTION_DIR, YUNET_MODEL_FILE)) -> None:
+    """Download the YuNet model from the OpenCV model zoo"""
+    # Imported here, as it's needed only once
+    import urllib.request
+
+    temp_path = f"{model_path}.download"
+    urllib.request.urlretrieve(YUNET_MODEL_URL, temp_path)
+    os.replace(temp_path, model_path)
+    print(f"The YuNet model was saved to {model_path}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["download"]:
+        sys.exit("Usage: python -m utils.face_detectors download")
+    download_yunet_model()
@@ -0,0 +1,147 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterable, Tuple
+from urllib.parse import urlparse
+
+from singleton_decorator import singleton
+
+from utils import metrics
+from utils.image_store import ImageStore
+from utils.paths import HTTP_CACHE_DIR
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SESSION_POOL_SIZE = 16
+
+
+class OfflineCacheMiss(Exception):
+    """The response is required in offline mode, but it was never stored"""
+
+
+@singleton
+class HttpCache:
+    """
+    On-disk cache of the scraping engines responses.
+    The downloaded images are stored (in the image store) along with their validators (ETag,
+    Last-Modified), and are revalidated with conditional requests, so unchanged images aren't
+    downloaded again. Pages which are rendered by a browser can't be revalidated, so their rendered
+    content is stored (compressed) as a snapshot. In offline mode, everything is served from the stored responses and
+    snapshots, e.g. for re-parsing the whole site after a parsing change, without any network traffic.
+    """
+
+    def __init__(self, root: str = HTTP_CACHE_DIR, offline: bool = False) -> None:
+        self.root = os.path.join(os.getcwd(), root)
+        self.offline = offline
+        self._session = None
+
+    @property
+    def session(self):
+        """HTTP session, pooling the connections of all the requests"""
+        if self._session is None:
+            # Imported here, as it's not needed offline
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            # Enough pooled connections for the parallel downloads
+            adapter = HTTPAdapter(pool_maxsize=SESSION_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    def _paths(self, kind: str, key: str) -> Tuple[str, str]:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        dir_path = os.path.join(self.root, kind, digest[:2])
+        return os.path.join(dir_path, f"{digest}.json"), os.path.join(dir_path, f"{digest}.gz")
+
+    def _load(self, kind: str, key: str) -> Tuple[dict, bytes] | None:
+        meta_path, body_path = self._paths(kind, key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as fp:
+                meta = json.load(fp)
+            with gzip.open(body_path, "rb") as fp:
+                return meta, fp.read()
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, kind: str, key: str, meta: dict, body: bytes) -> None:
+        meta_path, body_path = self._paths(kind, key)
+        Path(os.path.dirname(meta_path)).mkdir(parents=True, exist_ok=True)
+        # The body is written first (and the metadata last), so a cut write is never served
+        for path, content in [
+            (body_path, gzip.compress(body)),
+            (meta_path, json.dumps({"key": key, **meta}, ensure_ascii=False).encode()),
+        ]:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(content)
+            os.replace(temp_path, path)
+
+    def download_image(self, url: str, views: Iterable[str] = (), source: str = "") -> str:
+        """
+        Download the original image into the image store, streamed in chunks, and return its blob path.
+        The source is the kind of the source of the image, which is recorded by the image store.
+        Only the validators and the digest of the image are stored here (its content is in the image store),
+        so an image which was already downloaded is revalidated, and is not downloaded again if it wasn't changed.
+        """
+        suffix = os.path.splitext(urlparse(url).path)[1] or ".jpg"
+        cached = self._load("images", url)
+        blob_path = None
+        if cached:
+            blob_path = ImageStore().blob_path(cached[0]["digest"], suffix)
+            if not os.path.isfile(blob_path):
+                cached, blob_path = None, None
+        if self.offline:
+            if blob_path is None:
+                raise OfflineCacheMiss(url)
+            metrics.increment("http_cache_requests", result="offline")
+            return ImageStore().add_file(blob_path, views, source)
+        headers = {}
+        if cached:
+            meta, _ = cached
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        with self.session.get(url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 304 and blob_path:
+                metrics.increment("http_cache_requests", result="not_modified")
+                return ImageStore().add_file(blob_path, views, source)
+            response.raise_for_status()
+            blob_path = ImageStore().add_stream(
+                response.iter_content(DOWNLOAD_CHUNK_SIZE), suffix, views, source
+            )
+            self._store(
+                "images",
+                url,
+                {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "digest": os.path.splitext(os.path.basename(blob_path))[0],
+                    "fetched_at": time.time(),
+                },
+                b"",
+            )
+        metrics.increment("http_cache_requests", result="downloaded")
+        return blob_path
+
+    def store_snapshot(self, key: str, snapshot: dict) -> None:
+        """Store the rendered content of a page"""
+        self._store(
+            "snapshots",
+            key,
+            {"fetched_at": time.time()},
+            json.dumps(snapshot, ensure_ascii=False).encode(),
+        )
+
+    def load_snapshot(self, key: str) -> dict:
+        cached = self._load("snapshots", key)
+        if cached is None:
+            raise OfflineCacheMiss(key)
+        metrics.increment("http_cache_requests", result="snapshot")
+        return json.loads(cached[1])
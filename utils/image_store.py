@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+from singleton_decorator import singleton
+
+from utils.paths import IMAGE_STORE_DIR
+
+# The kinds of the images sources, which are recorded along with the blobs
+DATASET_SOURCE = "dataset"
+INSTAGRAM_SOURCE = "instagram"
+EXTERNAL_IMAGES_SOURCE = "external_images"
+
+
+def _file_key(stat: os.stat_result) -> str:
+    """Identify a file content by its inode, so a hardlinked view is not hashed again"""
+    return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _sha256_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _link(source: str, target: str) -> None:
+    """Make target a hardlink to the source (or a copy of it, when hardlinks are not supported)"""
+    if os.path.isfile(target) and os.path.samefile(source, target):
+        return
+    Path(os.path.dirname(target)).mkdir(parents=True, exist_ok=True)
+    temp_target = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, temp_target)
+    except OSError:
+        shutil.copy2(source, temp_target)
+    os.replace(temp_target, target)
+
+
+@singleton
+class ImageStore:
+    """
+    Content-addressed store of images, keyed by their SHA-256.
+    Each unique image is kept once, as a blob, and the records refer to the blobs. The existing
+    directories layouts (IDF images, external posts, the external images pool) are kept as hardlinked
+    views of the blobs, so the disk usage scales with the unique images.
+    A view is always replaced (written to a temporary file, which is renamed over it), never written
+    in place, so it can't change its blob: the downloads are written so (by _link, and instaloader),
+    and the external images pool files must be replaced, rather than edited in place, too.
+    The kind of the source of each image (e.g. an Instagram post) is recorded along with its blob.
+    """
+
+    INDEX_FILE_NAME = "index.jsonl"
+    # The index is rewritten on load when it has this many times more lines than live entries
+    INDEX_COMPACTION_RATIO = 2
+
+    def __init__(self, root: str = IMAGE_STORE_DIR) -> None:
+        self.root = os.path.join(os.getcwd(), root)
+        self.index_path = os.path.join(self.root, self.INDEX_FILE_NAME)
+        self._digests: Dict[str, str] = {}  # File key -> SHA-256
+        self._sources: Dict[str, str] = {}  # SHA-256 -> The kind of its source
+        self._index_offset = 0  # The size of the index which was read
+        self._lock = threading.Lock()
+        Path(self.root).mkdir(parents=True, exist_ok=True)
+        if os.path.isfile(self.index_path):
+            self._load_index()
+
+    def _read_index(self) -> List[dict]:
+        """The index entries which were appended since it was last read (by this process, or by others)"""
+        entries = []
+        with open(self.index_path, "rb") as fp:
+            fp.seek(self._index_offset)
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    break  # A line which is being written
+                self._index_offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # A line which was cut in the middle of writing
+                entries.append(entry)
+                if entry.get("source"):
+                    self._sources[entry["digest"]] = entry["source"]
+        return entries
+
+    def _load_index(self) -> None:
+        """Load the live entries of the index (of files which were not changed or removed since), and compact it"""
+        entries = self._read_index()
+        live_entries = {}
+        for entry in entries:
+            try:
+                if _file_key(os.stat(entry["path"])) == entry["key"]:
+                    live_entries[entry["key"]] = entry
+            except (KeyError, OSError):
+                continue  # An entry of an older index (without a path), or of a removed file
+        self._digests = {key: entry["digest"] for key, entry in live_entries.items()}
+        if self.INDEX_COMPACTION_RATIO * max(len(live_entries), 1) < len(entries):
+            fd, temp_path = tempfile.mkstemp(dir=self.root)
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                for entry in live_entries.values():
+                    source = self._sources.get(entry["digest"])
+                    fp.write(json.dumps({**entry, "source": source} if source else entry) + "\n")
+                self._index_offset = fp.tell()
+            os.replace(temp_path, self.index_path)
+
+    def blob_path(self, digest: str, suffix: str) -> str:
+        """The stable path of the image with the given digest"""
+        return os.path.join(self.root, digest[:2], f"{digest}{suffix.lower()}")
+
+    def _remember(self, path: str, digest: str, source: str = "") -> None:
+        key = _file_key(os.stat(path))
+        with self._lock:
+            if self._digests.get(key) != digest or (source and self._sources.get(digest) != source):
+                self._digests[key] = digest
+                entry = {"key": key, "digest": digest, "path": path}
+                if source:
+                    self._sources[digest] = entry["source"] = source
+                with open(self.index_path, "a", encoding="utf-8") as fp:
+                    fp.write(json.dumps(entry) + "\n")
+
+    def source(self, path: str) -> str:
+        """The kind of the source which the image was added from (an empty string if it's unknown)"""
+        key = _file_key(os.stat(path))
+        with self._lock:
+            digest = self._digests.get(key)
+            if (digest is None or digest not in self._sources) and os.path.isfile(self.index_path):
+                # The image may have been added by another process (e.g. by the collect stage)
+                for entry in self._read_index():
+                    self._digests[entry["key"]] = entry["digest"]
+                digest = self._digests.get(key)
+        return self._sources.get(digest, "")
+
+    def digest(self, path: str) -> str:
+        """The SHA-256 of the file content, which is hashed only if it's not known by the file key"""
+        key = _file_key(os.stat(path))
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = _sha256_file(path)
+            self._remember(path, digest)
+        return digest
+
+    def add_file(self, path: str, views: Iterable[str] = (), source: str = "") -> str:
+        """
+        Store the image in the given path and return its blob path.
+        The given path (and the other given views) become hardlinks to the blob: a new image is linked
+        into the store, and a duplicate of a stored image is replaced by a link to its blob.
+        The given source is the kind of the source of the image (e.g. INSTAGRAM_SOURCE).
+        """
+        digest = self.digest(path)
+        blob_path = self.blob_path(digest, os.path.splitext(path)[1])
+        if not os.path.isfile(blob_path):
+            _link(path, blob_path)
+        for view in [path, *views]:
+            _link(blob_path, view)
+        self._remember(blob_path, digest, source)
+        return blob_path
+
+    def add_bytes(
+        self, data: bytes, suffix: str, views: Iterable[str] = (), source: str = ""
+    ) -> str:
+        """Store the given image content and return its blob path. The given views become hardlinks to the blob."""
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.blob_path(digest, suffix)
+        if not os.path.isfile(blob_path):
+            Path(os.path.dirname(blob_path)).mkdir(parents=True, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path))
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.replace(temp_path, blob_path)
+        for view in views:
+            _link(blob_path, view)
+        self._remember(blob_path, digest, source)
+        return blob_path
+
+    def add_stream(
+        self, chunks: Iterable[bytes], suffix: str, views: Iterable[str] = (), source: str = ""
+    ) -> str:
+        """
+        Store the image content, given in chunks (e.g. of a streamed download), and return its blob path.
+        The content is hashed while it's written, and it's dropped if the store already has it.
+        The given views become hardlinks to the blob.
+        """
+        Path(self.root).mkdir(parents=True, exist_ok=True)
+        sha256 = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                for chunk in chunks:
+                    sha256.update(chunk)
+                    fp.write(chunk)
+            digest = sha256.hexdigest()
+            blob_path = self.blob_path(digest, suffix)
+            if not os.path.isfile(blob_path):
+                Path(os.path.dirname(blob_path)).mkdir(parents=True, exist_ok=True)
+                os.replace(temp_path, blob_path)
+        finally:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+        for view in views:
+            _link(blob_path, view)
+        self._remember(blob_path, digest, source)
+        return blob_path
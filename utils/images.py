@@ -4,30 +4,92 @@ import imagehash
 import cv2
 import cv2.typing
 
+from utils import metrics
+from utils.face_detectors import FaceDetector, create_detector, image_source
 
+
+FACE_DETECTOR_ENGINE = "cascades"
+DETECTION_MAX_SIDE = 0  # Images are downscaled to this size for the detection (0 for full resolution)
+DETECTION_ADAPTIVE = False  # Order the cascades by their saved hit statistics
+DETECTION_MAX_PASSES: int | None = None  # Maximal number of cascades tried per image
+DETECTION_CONCURRENCY = 0  # Number of threads for running the cascades speculatively (0 for sequential)
+# Cascades tried in the full resolution after an ambiguous downscaled result (None for the whole chain, as without downscaling)
+DETECTION_REFINEMENT_PASSES: int | None = None
+_face_detector: FaceDetector | None = None
+
+
+def set_face_detector(
+    engine: str,
+    max_side: int = DETECTION_MAX_SIDE,
+    adaptive: bool = DETECTION_ADAPTIVE,
+    max_passes: int | None = DETECTION_MAX_PASSES,
+    concurrency: int = DETECTION_CONCURRENCY,
+    refinement_passes: int | None = DETECTION_REFINEMENT_PASSES,
+) -> None:
+    """Choose the face detection engine (one of face_detectors.ENGINES) and its options for the process"""
+    global FACE_DETECTOR_ENGINE, DETECTION_MAX_SIDE, DETECTION_ADAPTIVE, DETECTION_MAX_PASSES
+    global DETECTION_CONCURRENCY, DETECTION_REFINEMENT_PASSES, _face_detector
+    FACE_DETECTOR_ENGINE, DETECTION_MAX_SIDE = engine, max_side
+    DETECTION_ADAPTIVE, DETECTION_MAX_PASSES = adaptive, max_passes
+    DETECTION_CONCURRENCY, DETECTION_REFINEMENT_PASSES = concurrency, refinement_passes
+    _face_detector = None
+
+
+def face_detector_settings() -> dict:
+    """The face detection engine and its options for the process (the arguments of set_face_detector)"""
+    return {
+        "engine": FACE_DETECTOR_ENGINE,
+        "max_side": DETECTION_MAX_SIDE,
+        "adaptive": DETECTION_ADAPTIVE,
+        "max_passes": DETECTION_MAX_PASSES,
+        "concurrency": DETECTION_CONCURRENCY,
+        "refinement_passes": DETECTION_REFINEMENT_PASSES,
+    }
+
+
+def get_face_detector() -> FaceDetector:
+    global _face_detector
+    if _face_detector is None:
+        _face_detector = create_detector(
+            FACE_DETECTOR_ENGINE,
+            DETECTION_ADAPTIVE,
+            DETECTION_MAX_PASSES,
+            DETECTION_CONCURRENCY,
+        )
+    return _face_detector
+
+
+@metrics.timed("detect_faces_seconds")
 def detect_faces(image_path: str) -> Sequence[cv2.typing.Rect]:
     """
-    Trys to deteced faces in the image
+    Trys to deteced faces in the image.
+    The detection runs over a downscaled copy of the image, and the face is returned in the
+    original image coordinations. Only ambiguous results are refined in the full resolution
+    (by the whole chain, unless DETECTION_REFINEMENT_PASSES limits it to the most likely cascades).
     """
-    faces = []
-    for xml in [
-        "opencv_frontalface_detection",
-        "haarcascade_frontalface_default",
-        "haarcascade_frontalface_alt",
-        "haarcascade_frontalface_alt2",
-        "haarcascade_frontalface_alt_tree",
-        "haarcascade_profileface_detection",
-        "haarcascade_mcs_eyepair_big",
-        "haarcascade_mcs_eyepair_small",
-        "haarcascade_smile",
-        "haarcascade_mcs_nose",
-        "haarcascade_mcs_mouth",
-    ]:
-        face_cascade = cv2.CascadeClassifier(f"utils/face_detection/{xml}.xml")
-        faces = face_cascade.detectMultiScale(cv2.imread(image_path), 1.1, 4)
+    img = cv2.imread(image_path)
+    if img is None:
+        return []
+    detector = get_face_detector()
+    if detector.grayscale:
+        # Converted before the resize, so only a single channel is resized
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    source = image_source(image_path)
+    height, width = img.shape[:2]
+    scale = DETECTION_MAX_SIDE / max(height, width) if DETECTION_MAX_SIDE else 1
+    if scale < 1:
+        small_img = cv2.resize(
+            img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA
+        )
+        faces = detector.detect(small_img, source)
         if len(faces) == 1:
-            break
-    return faces
+            # Map the rectangle back to the original image coordinations
+            return [tuple(round(value / scale) for value in faces[0][:4])]
+        # An ambiguous result (no face, or several), refined in the full resolution
+        metrics.increment("detect_faces_refinements")
+        faces = detector.refine(img, source, DETECTION_REFINEMENT_PASSES)
+        return [face[:4] for face in faces]
+    return [face[:4] for face in detector.detect(img, source)]
 
 
 def convert_to_rgb(img: Image) -> Image:
@@ -100,6 +162,7 @@ def resize(img: Image, new_width: int) -> Image:
 
 def is_duplication(img1_path: str, img2_path: str) -> bool:
     """Determine if the images were originally the same, ignoring their size, resolution and crop"""
+    metrics.increment("duplicates_comparisons")
     faces = [cut_face(img_path) for img_path in (img1_path, img2_path)]
     if all(faces):
         width = min([face.width for face in faces])
@@ -109,6 +172,7 @@ def is_duplication(img1_path: str, img2_path: str) -> bool:
         return hash_diff < 10
 
 
+@metrics.timed("remove_duplicates_images_seconds")
 def remove_duplicates_images(images_paths: List[str]) -> Tuple[List[str], List[str]]:
     """
     Check for similarity among the images and return list of unique images only.
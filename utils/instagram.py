@@ -1,4 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import io
+import json
+import threading
 import time
 import os
 import random
@@ -8,15 +12,20 @@ import instagrapi.exceptions
 import instaloader
 import instaloader.structures
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterator, List
 from dataclasses import dataclass
 from dataclasses_json import dataclass_json
 from singleton_decorator import singleton
 from PIL import Image
 
+from utils import logs, metrics
+from utils.image_store import INSTAGRAM_SOURCE, ImageStore
 from utils.images import convert_to_rgb, detect_faces, square_crop_coordinations
+from utils.json_storage import reload_data, write_data
 from utils.paths import is_image_file
 
+_log = logs.get_logger(__name__)
+
 
 @dataclass_json
 @dataclass
@@ -28,16 +37,89 @@ class PostContent:
     text: str
     images_paths: List[str]
     date_str: str
+    shortcode: str | None = None
+    media_downloaded: bool = True
 
     @property
     def date(self):
         return datetime.strptime(self.date_str, self.DATETIME_FORMAT)
 
 
+class PostsManifest:
+    """
+    Per-account record of the synced posts, appended as soon as each post (or its media) is done,
+    so an interrupted sync can be resumed without downloading a post twice
+    """
+
+    FILE_NAME = "manifest.jsonl"
+
+    def __init__(self, target_dir: str) -> None:
+        self.path = os.path.join(target_dir, self.FILE_NAME)
+        self.posts: Dict[str, PostContent] = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(self.path):
+            with open(self.path, "r", encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        post = PostContent.from_dict(json.loads(line))
+                    except ValueError:
+                        continue  # A line which was cut in the middle of writing
+                    self.posts[post.shortcode] = post
+
+    def __contains__(self, shortcode: str) -> bool:
+        return shortcode in self.posts
+
+    def record(self, post: PostContent) -> None:
+        """Add the given post to the manifest, overriding its previous record"""
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as fp:
+                fp.write(json.dumps(post.to_dict(), ensure_ascii=False) + "\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.posts[post.shortcode] = post
+
+
+class RateLimiter:
+    """Thread-safe rate limiter, sharing a budget of requests per minute among workers"""
+
+    def __init__(self, requests_per_minute: float) -> None:
+        self.interval = 60 / requests_per_minute
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until the next request is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+def _new_posts(
+    posts: Iterator[instaloader.structures.Post],
+    high_water_mark: datetime | None,
+    max_pinned_posts: int = 3,
+) -> Iterator[instaloader.structures.Post]:
+    """
+    Yield the posts which are newer than the high-water mark, from a newest-first posts iterator.
+    Pinned posts are listed first, out of chronological order, so the iteration stops only
+    after more already-synced posts were reached than the number of posts that may be pinned.
+    """
+    old_posts = 0
+    for post in posts:
+        if not high_water_mark or high_water_mark < post.date:
+            yield post
+        else:
+            old_posts += 1
+            if max_pinned_posts < old_posts:
+                break
+
+
 def _random_sleep(min_minutes: float, max_minutes: float):
     """Random sleep for <min_minutes> and up to <max_minutes> minutes"""
     sleep_seconds = random.randint(round(min_minutes * 60), round(max_minutes * 60))
-    print(f"Going to sleep for {sleep_seconds} seconds before publishing...")
+    _log.info("Going to sleep before publishing", extra={"sleep_seconds": sleep_seconds})
     time.sleep(sleep_seconds)
 
 
@@ -45,47 +127,124 @@ def _random_sleep(min_minutes: float, max_minutes: float):
 class InstagramScraper:
     """Instagram scraper for downloading posts from public accounts"""
 
+    MAX_WORKERS = 4
+    REQUESTS_PER_MINUTE = 20
+    SYNC_STATE_FILE_NAME = "sync_state.json"
+
     def __init__(self, instagram_user: str, intagram_password: str) -> None:
         self.loader = instaloader.Instaloader()
         self.loader.login(instagram_user, intagram_password)
+        self.pool = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        self.rate_limiter = RateLimiter(self.REQUESTS_PER_MINUTE)
 
     def _download_post(
         self, post: instaloader.structures.Post, target_dir: str
     ) -> PostContent:
         """Download a single Instagram post and return its text and its images paths"""
-        self.loader.download_post(post, target_dir)
+        Path(target_dir).mkdir(parents=True, exist_ok=True)
+        filename = os.path.join(target_dir, f"{post.date_utc:%Y-%m-%d_%H-%M-%S}_UTC")
+        if post.typename == "GraphSidecar":
+            urls = [node.display_url for node in post.get_sidecar_nodes()]
+        else:
+            urls = [post.url]
+        for i, url in enumerate(urls, start=1):
+            self.rate_limiter.wait()
+            self.loader.download_pic(
+                filename,
+                url,
+                post.date_local,
+                filename_suffix=str(i) if 1 < len(urls) else None,
+            )
+        if post.caption:
+            self.loader.save_caption(filename, post.date_local, post.caption)
         text, images_paths = "", []
         for file_name in os.listdir(target_dir):
-            file_path = os.path.join(os.getcwd(), target_dir, file_name)
+            file_path = os.path.join(target_dir, file_name)
             if file_name.endswith(".txt"):
-                with open(file_path) as fp:
+                with open(file_path, encoding="utf-8") as fp:
                     text = fp.read()
             elif is_image_file(file_path):
-                images_paths.append(file_path)
+                images_paths.append(ImageStore().add_file(file_path, source=INSTAGRAM_SOURCE))
         return PostContent(
             text=text,
             images_paths=images_paths,
             date_str=post.date.strftime(PostContent.DATETIME_FORMAT),
+            shortcode=post.shortcode,
         )
 
-    def download_posts(
+    def sync_posts(
         self, account: str, target_dir: str, starting_date: datetime | None = None
     ) -> List[PostContent]:
-        """Download all the post from the given Instagram account"""
+        """
+        Sync the metadata and the captions of the new posts from the given Instagram account,
+        without their media (see download_media).
+        Posts which were recorded in the account manifest by an interrupted previous run
+        are returned without being synced again.
+        The account's high-water mark (the date of the newest synced post) is kept in the
+        target directory, so the posts listing stops as soon as it reaches synced posts.
+        """
+        target_dir = os.path.join(os.getcwd(), target_dir)
         Path(target_dir).mkdir(parents=True, exist_ok=True)
-        wd = os.getcwd()
-        os.chdir(target_dir)
+        manifest = PostsManifest(target_dir)
+        sync_state_path = os.path.join(target_dir, self.SYNC_STATE_FILE_NAME)
+        sync_state = reload_data(sync_state_path) or {}
+        high_water_mark = starting_date
+        if sync_state.get("high_water_mark"):
+            stored_mark = datetime.strptime(
+                sync_state["high_water_mark"], PostContent.DATETIME_FORMAT
+            )
+            high_water_mark = max(filter(None, [high_water_mark, stored_mark]))
+        synced_posts = [
+            post
+            for post in manifest.posts.values()
+            if not starting_date or starting_date < post.date
+        ]
+
         profile = instaloader.Profile.from_username(self.loader.context, account)
-        page_posts = profile.get_posts()
-        downloaded_posts = []
-        for post in page_posts:
-            if not starting_date or starting_date < post.date:
-                timestamp = post.date.strftime(PostContent.DATETIME_FORMAT)
-                target_sub_dir = f"{account}_{timestamp}"
-                downloaded_posts.append(self._download_post(post, target_sub_dir))
-                _random_sleep(0, 0.1)
-        os.chdir(wd)
-        return downloaded_posts
+        for post in _new_posts(profile.get_posts(), high_water_mark):
+            if post.shortcode not in manifest:
+                post_content = PostContent(
+                    text=post.caption or "",
+                    images_paths=[],
+                    date_str=post.date.strftime(PostContent.DATETIME_FORMAT),
+                    shortcode=post.shortcode,
+                    media_downloaded=False,
+                )
+                manifest.record(post_content)
+                synced_posts.append(post_content)
+
+        # All the new posts are synced
+        if synced_posts:
+            high_water_mark = max(
+                filter(None, [high_water_mark] + [post.date for post in synced_posts])
+            )
+        if high_water_mark:
+            sync_state["high_water_mark"] = high_water_mark.strftime(
+                PostContent.DATETIME_FORMAT
+            )
+            write_data(sync_state, sync_state_path)
+        return synced_posts
+
+    def download_media(
+        self, account: str, target_dir: str, posts: List[PostContent]
+    ) -> List[PostContent]:
+        """Download the images of the given (already synced) posts, using the workers pool"""
+        target_dir = os.path.join(os.getcwd(), target_dir)
+        manifest = PostsManifest(target_dir)
+
+        def download(post_content: PostContent) -> PostContent:
+            self.rate_limiter.wait()
+            post = instaloader.Post.from_shortcode(
+                self.loader.context, post_content.shortcode
+            )
+            downloaded_post = self._download_post(
+                post, os.path.join(target_dir, f"{account}_{post_content.date_str}")
+            )
+            manifest.record(downloaded_post)
+            return downloaded_post
+
+        futures = [self.pool.submit(download, post) for post in posts]
+        return [future.result() for future in as_completed(futures)]
 
 
 @singleton
@@ -124,7 +283,7 @@ class InstagramClient:
                             "Couldn't logged in using session information"
                         )
                     else:
-                        print("\nLogged in to Instagram using session information\n")
+                        _log.info("Logged in to Instagram using session information")
                 else:
                     raise self.LoginException(
                         "No previous session information is avilable"
@@ -137,7 +296,7 @@ class InstagramClient:
                         "Couldn't logged in using username and password"
                     )
                 else:
-                    print("\nLogged in to Instagram using username and password\n")
+                    _log.info("Logged in to Instagram using username and password")
 
             finally:
                 self.instagram_client.dump_settings(self._session_file_name)
@@ -157,6 +316,7 @@ class InstagramClient:
         return f"instagram_session_{self.instagram_user}.json"
 
     @classmethod
+    @metrics.timed("prepare_image_for_instagram_seconds")
     def _prepare_image_for_instagram(cls, path: str) -> str:
         """Modify the image to make it ready for Instagram standard"""
         img = Image.open(path)
@@ -176,9 +336,14 @@ class InstagramClient:
             # Crop
             img = img.crop((left, top, right, bottom))
         # Save
-        new_path = f"{path}.jpg"
-        img.save(new_path)
-        return new_path
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG")
+        return ImageStore().add_bytes(buffer.getvalue(), ".jpg")
+
+    @classmethod
+    def prepare_images(cls, paths: List[str]) -> List[str]:
+        """Make the images ready for Instagram standard (doesn't require a session)"""
+        return [cls._prepare_image_for_instagram(path) for path in paths]
 
     def publish_post(
         self,
@@ -186,37 +351,37 @@ class InstagramClient:
         post_main_image_path: str,
         post_additional_images_paths: List[str],
         dry_run: bool = False,
+        prepared: bool = False,
     ) -> instagrapi.types.Media | bool | None:
-        """Publish an Instagram post"""
-        post_caption_first_row = post_cation.split("\n")[0]
-        print(
-            f"""
-            Going to publish a post:
-            {post_caption_first_row}
-            {post_main_image_path}
-            {post_additional_images_paths}
-            """
+        """Publish an Instagram post (the additional images are made ready for Instagram, unless already prepared)"""
+        _log.info(
+            "Going to publish a post",
+            extra={
+                "caption": post_cation.split("\n")[0],
+                "main_image": post_main_image_path,
+                "additional_images": post_additional_images_paths,
+            },
         )
         post_images_paths = [post_main_image_path]
-        post_additional_images_paths = [
-            self._prepare_image_for_instagram(path)
-            for path in post_additional_images_paths
-        ]
-        post_images_paths.extend(post_additional_images_paths)
+        post_images_paths.extend(
+            post_additional_images_paths
+            if prepared
+            else self.prepare_images(post_additional_images_paths)
+        )
         if dry_run:
             published = True
         else:
             _random_sleep(1, 3)
             self._init_instagram_session()
-            published = (
-                self.instagram_client.album_upload(
-                    post_images_paths, caption=post_cation
-                )
-                if 1 < len(post_images_paths)
-                else self.instagram_client.photo_upload(
-                    post_images_paths[0], caption=post_cation
+            upload_kind = "album" if 1 < len(post_images_paths) else "photo"
+            with metrics.timer("instagram_upload_seconds", kind=upload_kind):
+                published = (
+                    self.instagram_client.album_upload(
+                        post_images_paths, caption=post_cation
+                    )
+                    if 1 < len(post_images_paths)
+                    else self.instagram_client.photo_upload(
+                        post_images_paths[0], caption=post_cation
+                    )
                 )
-            )
-        for path in post_additional_images_paths:
-            os.remove(path)
         return published
@@ -1,17 +1,162 @@
+"""
+Storage of the data files (the datasets, the external posts, etc.).
+
+The files are written in one of the FORMATS, and the format of a file is detected from its content
+when it's read, so the files keep their names whatever their format is. Rewriting a file keeps its
+current format, and new files are written in DATA_FORMAT. The human-readable JSON is always available
+as an export:
+
+    python -m utils.json_storage convert --format msgpack iron_swords/iron_swords.json
+    python -m utils.json_storage export iron_swords/iron_swords.json iron_swords.export.json
+"""
+import argparse
 import json
+import os
+import stat
+import tempfile
 from typing import List
 
+from utils import metrics
+
+# "json" is the readable (indented) JSON, "orjson" is a compact JSON, which is encoded and decoded
+# much faster (requires orjson), and "msgpack" is binary (requires msgpack)
+FORMATS = ["json", "orjson", "msgpack"]
+DATA_FORMAT = "json"  # The format of the new files
+_UTF8_BOM = b"\xef\xbb\xbf"
+
+
+def set_data_format(data_format: str) -> None:
+    """Choose the format of the new files (one of FORMATS)"""
+    global DATA_FORMAT
+    DATA_FORMAT = data_format
+
+
+def _orjson():
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def _msgpack():
+    # Imported here, as it's required only for the msgpack files
+    import msgpack
+
+    return msgpack
+
+
+def detect_format(content: bytes) -> str:
+    """The format of the file content (JSON, or msgpack)"""
+    stripped = content.lstrip()
+    if not stripped or stripped[:1] in b"[{\"" or stripped[:3] == _UTF8_BOM:
+        return "json"
+    return "msgpack"
+
+
+def encode(data, data_format: str) -> bytes:
+    if data_format == "msgpack":
+        return _msgpack().packb(data, use_bin_type=True)
+    if data_format == "orjson":
+        orjson = _orjson()
+        if orjson is None:
+            # The same compact JSON, only slower
+            return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=4, ensure_ascii=False).encode("utf-8")
 
-def write_data(data, filepath):
-    with open(filepath, 'w', encoding='utf-8') as fp:
-        json.dump(data, fp, indent=4, ensure_ascii=False)
 
+def decode(content: bytes):
+    if detect_format(content) == "msgpack":
+        return _msgpack().unpackb(content, raw=False, strict_map_key=False)
+    content = content.removeprefix(_UTF8_BOM)  # orjson doesn't skip it
+    orjson = _orjson()
+    return orjson.loads(content) if orjson else json.loads(content.decode("utf-8"))
 
+
+def file_format(filepath: str) -> str | None:
+    """The format of the existing file (None if it doesn't exist, or is empty). Compact JSON is detected by its first line."""
+    try:
+        with open(filepath, "rb") as fp:
+            head = fp.read(4096)
+    except OSError:
+        return None
+    if detect_format(head) == "msgpack":
+        return "msgpack"
+    first_line = head.lstrip().split(b"\n", 1)[0].strip()
+    if first_line in (b"[]", b"{}", b""):
+        return None  # Empty, so it has no format to keep
+    # The readable JSON is indented, so its first line is only the opening bracket
+    return "json" if len(first_line) == 1 else "orjson"
+
+
+def _write_atomically(content: bytes, filepath: str) -> None:
+    """Write the file through a temporary file, which replaces it, so a cut write never truncates it"""
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filepath)), prefix=f".{os.path.basename(filepath)}."
+    )
+    try:
+        # Keep the permissions of the replaced file (the temporary file is created private)
+        os.chmod(temp_path, stat.S_IMODE(os.stat(filepath).st_mode) if os.path.isfile(filepath) else 0o644)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, filepath)
+    except BaseException:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@metrics.timed("write_data_seconds")
+def write_data(data, filepath, data_format: str | None = None):
+    """Write the data to the file, in the given format (by default, the current format of the file)"""
+    data_format = data_format or file_format(filepath) or DATA_FORMAT
+    _write_atomically(encode(data, data_format), filepath)
+
+
+@metrics.timed("reload_data_seconds")
 def reload_data(json_path: str) -> List[dict]:
-    """Reload the data from the file"""
+    """
+    Reload the data from the file (empty, if the file is missing or empty).
+    A file which can't be decoded fails, rather than being read as empty and then overwritten.
+    """
     try:
-        with open(json_path, "r") as fp:
-            data = json.load(fp)
-        return data
-    except:
+        with open(json_path, "rb") as fp:
+            content = fp.read()
+    except FileNotFoundError:
         return []
+    if not content.removeprefix(_UTF8_BOM).strip():
+        return []
+    return decode(content)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m utils.json_storage",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="Convert the files to the given format, in place")
+    convert_parser.add_argument("--format", choices=FORMATS, required=True)
+    convert_parser.add_argument("files", nargs="+")
+    export_parser = subparsers.add_parser("export", help="Export the file as a readable JSON")
+    export_parser.add_argument("file")
+    export_parser.add_argument("output")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # The files are decoded directly, so an unreadable file fails, rather than being read as empty
+    if args.command == "convert":
+        for filepath in args.files:
+            with open(filepath, "rb") as fp:
+                write_data(decode(fp.read()), filepath, args.format)
+            print(f"{filepath} was converted to {args.format}")
+    else:
+        with open(args.file, "rb") as fp:
+            write_data(decode(fp.read()), args.output, "json")
+        print(f"{args.file} was exported to {args.output}")
@@ -0,0 +1,191 @@
+"""
+Structured event log, written as JSON lines.
+
+The records are handed off through a queue to a single listener thread, which formats and writes
+them, so the threads and the worker processes don't contend on the output. The records of the process
+itself go through an in-process queue, and only the worker processes (whose pools are created with
+the worker_initializer) send theirs through a multiprocessing queue. Each record carries the
+correlation ID of the casualty it's about, and the trace span (collect, build, publish, etc.) it was
+logged in. Debug records of the hot paths are dropped before they're created, unless the level is DEBUG.
+
+    from utils import logs
+
+    _log = logs.get_logger(__name__)
+
+    with logs.span("build"):
+        with logs.correlation(casualty.data_url):
+            _log.info("Post was created", extra={"post_path": post_path})
+
+    multiprocessing.Pool(initializer=logs.worker_initializer, initargs=logs.worker_initargs())
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.queues
+import os
+import queue
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+ROOT_LOGGER_NAME = "memorialization"
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+_correlation_id: ContextVar[str | None] = ContextVar("correlation_id", default=None)
+_span: ContextVar[tuple | None] = ContextVar("span", default=None)  # (name, ID)
+_listener: logging.handlers.QueueListener | None = None
+_workers_listener: logging.handlers.QueueListener | None = None
+_workers_queue: multiprocessing.queues.Queue | None = None
+
+# The attributes of every log record, which are not extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+def get_logger(name: str) -> logging.Logger:
+    """The logger of the module, under the root logger of the tool"""
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+
+
+class _ContextFilter(logging.Filter):
+    """Add the correlation ID and the span to the record, in the thread (or process) that logged it"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = _correlation_id.get()
+        current_span = _span.get()
+        record.span, record.span_id = current_span or (None, None)
+        record.process_id = os.getpid()
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", None),
+            "span": getattr(record, "span", None),
+            "span_id": getattr(record, "span_id", None),
+            "process": getattr(record, "process_id", record.process),
+        }
+        event.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES and key not in event and key != "process_id"
+        )
+        if record.exc_text:
+            event["exception"] = record.exc_text
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only the exception is formatted here, as the message and the extra fields
+        # are formatted by the listener
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+
+def _set_queue(records_queue, level: str | int) -> None:
+    """Hand off the records of the root logger of the tool to the queue"""
+    root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+    root_logger.setLevel(level)
+    root_logger.propagate = False
+    queue_handler = _QueueHandler(records_queue)
+    queue_handler.addFilter(_ContextFilter())
+    root_logger.handlers = [queue_handler]
+
+
+def configure(level: str = "INFO", path: str | None = None) -> None:
+    """
+    Write the log records of the given level (and above) as JSON lines to the file (or to stderr).
+    The queued records are written when the process exits.
+    """
+    global _listener
+    shutdown()
+    records_queue = queue.SimpleQueue()
+    _set_queue(records_queue, level)
+    output_handler = (
+        logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler(sys.stderr)
+    )
+    output_handler.setFormatter(JsonLinesFormatter())
+    _listener = logging.handlers.QueueListener(records_queue, output_handler)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def worker_initargs() -> tuple:
+    """
+    The arguments of worker_initializer, for the pools of worker processes: the multiprocessing queue
+    (created on the first pool, and written by the listener of this process), and the level
+    """
+    global _workers_listener, _workers_queue
+    if _listener is None:
+        return None, logging.NOTSET  # Not configured, so the workers are not configured either
+    if _workers_queue is None:
+        _workers_queue = multiprocessing.Queue(-1)
+        _workers_listener = logging.handlers.QueueListener(_workers_queue, *_listener.handlers)
+        _workers_listener.start()
+    return _workers_queue, logging.getLogger(ROOT_LOGGER_NAME).level
+
+
+def worker_initializer(records_queue: multiprocessing.queues.Queue | None, level: str | int) -> None:
+    """Send the log records of the worker process to the listener of its parent (whether it was forked or spawned)"""
+    global _listener, _workers_listener, _workers_queue
+    # A forked worker inherits the listeners of its parent, which are not running in it
+    _listener = _workers_listener = _workers_queue = None
+    if records_queue is not None:
+        _set_queue(records_queue, level)
+
+
+def shutdown() -> None:
+    """Write the queued records, and stop the listeners"""
+    global _listener, _workers_listener, _workers_queue
+    if _workers_listener is not None:
+        _workers_listener.stop()
+        _workers_queue.close()
+        _workers_listener = _workers_queue = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+@contextmanager
+def correlation(correlation_id: str):
+    """Tag the records of the block with the correlation ID (e.g. the data URL of the casualty)"""
+    token = _correlation_id.set(correlation_id)
+    try:
+        yield
+    finally:
+        _correlation_id.reset(token)
+
+
+@contextmanager
+def span(name: str, **fields):
+    """Trace the block as a span: the records of the block are tagged with it, and its end is logged with its duration"""
+    logger = get_logger("spans")
+    token = _span.set((name, uuid.uuid4().hex[:12]))
+    start = time.perf_counter()
+    logger.debug("Span started", extra=fields)
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        logger.info(
+            "Span ended",
+            extra={**fields, "status": status, "duration_seconds": time.perf_counter() - start},
+        )
+        _span.reset(token)
@@ -0,0 +1,194 @@
+import functools
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Tuple
+
+PROMETHEUS_PREFIX = "memorialization"
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, math.inf)
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, object]) -> _Key:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Registry:
+    """Counters and histograms of a single process"""
+
+    def __init__(self) -> None:
+        self.counters: Dict[_Key, float] = {}
+        self.histograms: Dict[_Key, List[float]] = {}  # Buckets counts, then sum and count
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                key, [0] * (len(SECONDS_BUCKETS) + 2)
+            )
+            for i, bucket in enumerate(SECONDS_BUCKETS):
+                if value <= bucket:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self) -> dict:
+        """Plain (picklable and JSON serializable) copy of the metrics"""
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "buckets": histogram[:-2],
+                        "sum": histogram[-2],
+                        "count": histogram[-1],
+                    }
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def merge(self, snapshot: dict) -> None:
+        """Add the metrics of the given snapshot (e.g. of another process) to this registry"""
+        with self._lock:
+            for counter in snapshot["counters"]:
+                key = _key(counter["name"], counter["labels"])
+                self.counters[key] = self.counters.get(key, 0) + counter["value"]
+            for other in snapshot["histograms"]:
+                key = _key(other["name"], other["labels"])
+                histogram = self.histograms.setdefault(
+                    key, [0] * (len(SECONDS_BUCKETS) + 2)
+                )
+                for i, value in enumerate(
+                    other["buckets"] + [other["sum"], other["count"]]
+                ):
+                    histogram[i] += value
+
+
+REGISTRY = Registry()
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    """Increase a counter"""
+    REGISTRY.increment(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Add an observation to a histogram"""
+    REGISTRY.observe(name, value, **labels)
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """Measure the duration of the block, in seconds, into the given histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name: str, **labels) -> Callable:
+    """Decorator for measuring each call of the function into the given histogram"""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class collecting:
+    """
+    Wrap a function which runs in a worker process, so it returns its result along with
+    the metrics it produced. Use with pool_map, which merges them into the main process registry.
+    """
+
+    def __init__(self, func: Callable) -> None:
+        self.func = func
+
+    def __call__(self, *args):
+        global REGISTRY
+        parent_registry, REGISTRY = REGISTRY, Registry()
+        try:
+            result = self.func(*args)
+            return result, REGISTRY.snapshot()
+        finally:
+            REGISTRY = parent_registry
+
+
+def pool_map(pool, func: Callable, iterable: Iterable) -> list:
+    """multiprocessing.Pool.map, that keeps the metrics produced in the worker processes"""
+    results = []
+    for result, snapshot in pool.map(collecting(func), iterable):
+        REGISTRY.merge(snapshot)
+        results.append(result)
+    return results
+
+
+def _prometheus_labels(labels: Dict[str, str], **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = {
+        label: str(value).replace("\\", "\\\\").replace('"', '\\"')
+        for label, value in labels.items()
+    }
+    return "{" + ",".join(f'{label}="{value}"' for label, value in escaped.items()) + "}"
+
+
+def to_prometheus(snapshot: dict) -> str:
+    """Render the metrics in Prometheus text format"""
+    lines = []
+    typed = set()
+    for counter in sorted(snapshot["counters"], key=lambda c: c["name"]):
+        name = f"{PROMETHEUS_PREFIX}_{counter['name']}_total"
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_prometheus_labels(counter['labels'])} {counter['value']}")
+    for histogram in sorted(snapshot["histograms"], key=lambda h: h["name"]):
+        name = f"{PROMETHEUS_PREFIX}_{histogram['name']}"
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bucket, count in zip(SECONDS_BUCKETS, histogram["buckets"]):
+            cumulative += count
+            le = "+Inf" if bucket == math.inf else str(bucket)
+            lines.append(
+                f"{name}_bucket{_prometheus_labels(histogram['labels'], le=le)} {cumulative}"
+            )
+        lines.append(f"{name}_sum{_prometheus_labels(histogram['labels'])} {histogram['sum']}")
+        lines.append(f"{name}_count{_prometheus_labels(histogram['labels'])} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def export(target_dir: str) -> None:
+    """Write the metrics as JSON (metrics.json) and in Prometheus text format (metrics.prom)"""
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    snapshot = REGISTRY.snapshot()
+    with open(os.path.join(target_dir, "metrics.json"), "w", encoding="utf-8") as fp:
+        json.dump(snapshot, fp, indent=4, ensure_ascii=False)
+    with open(os.path.join(target_dir, "metrics.prom"), "w", encoding="utf-8") as fp:
+        fp.write(to_prometheus(snapshot))
@@ -0,0 +1,159 @@
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Set, TypeVar
+
+
+T = TypeVar("T")
+
+_NIQQUD = "".join(
+    chr(code) for code in range(0x0591, 0x05C8) if chr(code) not in "־׀׃׆"
+)
+_NORMALIZATION_TABLE = str.maketrans(
+    {
+        **{char: None for char in _NIQQUD},
+        # Geresh variants
+        "׳": "'",
+        "‘": "'",
+        "’": "'",
+        "`": "'",
+        "´": "'",
+        # Gershayim variants
+        "״": '"',
+        "“": '"',
+        "”": '"',
+        "„": '"',
+        # Final letters
+        "ך": "כ",
+        "ם": "מ",
+        "ן": "נ",
+        "ף": "פ",
+        "ץ": "צ",
+        # Maqaf
+        "־": "-",
+    }
+)
+_WHITESPACES = re.compile(r"\s+")
+_HONORIFIC_SUFFIX = re.compile(r'\s*(?:ז"ל|הי"ד)\s*$')
+# Letters which may be attached in front of a name, e.g. "ל" in "לנדב"
+_HEBREW_PREFIXES = "ובהכלמש"
+_MAX_PREFIXES = 3
+_HYPHEN = "-"
+
+
+def normalize_hebrew(text: str) -> str:
+    """
+    Normalize Hebrew text for matching:
+    remove niqqud, unify geresh/gershayim variants, final letters and maqaf, collapse whitespaces
+    """
+    text = text.translate(_NORMALIZATION_TABLE).replace("''", '"')
+    return _WHITESPACES.sub(" ", text).strip()
+
+
+def normalize_name(name: str) -> str:
+    """Normalize a name for matching, without its honorific suffix (e.g. ז"ל)"""
+    return _HONORIFIC_SUFFIX.sub("", normalize_hebrew(name))
+
+
+class NamesMatcher:
+    """
+    Aho-Corasick automaton of many names, for finding all of them in a text with a single scan.
+    A name matches only as a whole word, optionally with attached Hebrew prefixes (e.g. "ו", "ל").
+    A hyphen joins the words around it, so "נדב כהן" doesn't match "נדב כהן-לוי", but a hyphenated
+    name also matches with spaces instead of its hyphens ("נדב כהן-לוי" matches "נדב כהן לוי").
+    """
+
+    def __init__(self, names: Iterable[str]) -> None:
+        self._names: List[List[str]] = []  # Original names of each pattern
+        self._lengths: List[int] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+        patterns: Dict[str, int] = {}
+        for name in names:
+            pattern = normalize_name(name)
+            if not pattern:
+                continue
+            variants = [pattern]
+            if _HYPHEN in pattern:
+                variants.append(normalize_hebrew(pattern.replace(_HYPHEN, " ")))
+            for variant in variants:
+                if variant not in patterns:
+                    patterns[variant] = len(self._names)
+                    self._names.append([])
+                    self._lengths.append(len(variant))
+                    self._add(variant, patterns[variant])
+                self._names[patterns[variant]].append(name)
+        self._build()
+
+    def _add(self, pattern: str, pattern_id: int) -> None:
+        state = 0
+        for char in pattern:
+            if char not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        self._output[state].append(pattern_id)
+
+    def _build(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._output[next_state] = (
+                    self._output[next_state] + self._output[self._fail[next_state]]
+                )
+
+    @staticmethod
+    def _is_separator(char: str) -> bool:
+        return not char.isalnum() and char != _HYPHEN
+
+    @classmethod
+    def _is_word_start(cls, text: str, start: int) -> bool:
+        for _ in range(_MAX_PREFIXES + 1):
+            if start == 0 or cls._is_separator(text[start - 1]):
+                return True
+            if text[start - 1] not in _HEBREW_PREFIXES:
+                return False
+            start -= 1
+        return False
+
+    def find(self, text: str) -> Set[str]:
+        """Return the (original) names which appear in the given text"""
+        text = normalize_hebrew(text)
+        found: Set[int] = set()
+        goto, fail, output, lengths = self._goto, self._fail, self._output, self._lengths
+        state = 0
+        for end, char in enumerate(text, start=1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern_id in output[state]:
+                if (
+                    pattern_id not in found
+                    and (end == len(text) or self._is_separator(text[end]))
+                    and self._is_word_start(text, end - lengths[pattern_id])
+                ):
+                    found.add(pattern_id)
+        return {name for pattern_id in found for name in self._names[pattern_id]}
+
+
+def match_names(names: Iterable[str], posts: Iterable[T]) -> Dict[str, List[T]]:
+    """
+    Find which of the posts (anything with a text attribute) mention each of the names.
+    Every text is scanned only once, for all the names together.
+    """
+    matcher = NamesMatcher(names)
+    names_posts: Dict[str, List[T]] = {}
+    for post in posts:
+        for name in matcher.find(post.text):
+            names_posts.setdefault(name, []).append(post)
+    return names_posts
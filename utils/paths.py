@@ -4,13 +4,24 @@ import os
 EXTERNAL_IMAGES_DIR = "external_images"
 EXTERNAL_POSTS_DIR = "external_posts"
 GENERATED_POSTS_DIR = "generated_posts"
+IMAGE_STORE_DIR = "image_store"
+HTTP_CACHE_DIR = "http_cache"
+METRICS_DIR = "metrics"
+SHARDS_DIR = "shards"
+WORK_QUEUE_FILE = "work_queue.sqlite3"
+PREPARED_POSTS_FILE = "prepared_posts.json"
+VALIDATION_REPORT_FILE = "validation_report.json"
+EXTERNAL_IMAGES_INDEX_FILE = "external_images_index.json"
+FACE_DETECTION_STATISTICS_FILE = "face_detection_statistics.json"
+
+IMAGES_SUFFIXES = ("jpg", "jpeg", "png", "bmp")
+
+
+def has_image_suffix(path: str) -> bool:
+    """Checks whether the given path has an image file suffix"""
+    return path.lower().endswith(tuple(f".{suffix}" for suffix in IMAGES_SUFFIXES))
 
 
 def is_image_file(path: str) -> bool:
     """Checks whether the given path represent an existing image file"""
-    return any(
-        [
-            path.lower().endswith(f".{suffix}")
-            for suffix in ["jpg", "jpeg", "png", "bmp"]
-        ]
-    ) and os.path.isfile(path)
+    return has_image_suffix(path) and os.path.isfile(path)
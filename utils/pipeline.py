@@ -0,0 +1,203 @@
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Callable, Dict, Generator, Iterator, List
+
+from utils import logs, metrics
+from utils.json_storage import write_data
+
+_END = None  # Marks the end of a stage's queue
+_log = logs.get_logger(__name__)
+
+
+class DatasetWriter:
+    """
+    The dataset, updated record by record (by data_url) as the records go through the stages.
+    The dataset file is rewritten at most once in <flush_seconds>, and on finish.
+    """
+
+    def __init__(
+        self, casualties_data: List[dict], json_file: str, flush_seconds: float = 30
+    ) -> None:
+        self.json_file = json_file
+        self.flush_seconds = flush_seconds
+        self._records: Dict[str, dict] = {
+            casualty_data["data_url"]: casualty_data for casualty_data in casualties_data
+        }
+        self._touched = set()
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, casualty_data: dict) -> None:
+        with self._lock:
+            self._records[casualty_data["data_url"]] = casualty_data
+            self._touched.add(casualty_data["data_url"])
+            if self.flush_seconds < time.monotonic() - self._last_flush:
+                self._flush()
+
+    def reset(self, casualties_data: List[dict]) -> None:
+        """Replace the dataset with the given records, except for records that were already updated"""
+        with self._lock:
+            self._records = {
+                casualty_data["data_url"]: (
+                    self._records[casualty_data["data_url"]]
+                    if casualty_data["data_url"] in self._touched
+                    else casualty_data
+                )
+                for casualty_data in casualties_data
+            }
+
+    def untouched(self) -> List[dict]:
+        with self._lock:
+            return [
+                casualty_data
+                for data_url, casualty_data in self._records.items()
+                if data_url not in self._touched
+            ]
+
+    def _flush(self) -> None:
+        write_data(list(self._records.values()), self.json_file)
+        self._last_flush = time.monotonic()
+
+    def finish(self) -> List[dict]:
+        with self._lock:
+            self._flush()
+            return list(self._records.values())
+
+
+class _Stage(threading.Thread):
+    """
+    A pipeline stage thread, which always ends its output queue, and keeps its error for the main thread.
+    If the stage fails, its input queue is still consumed, so the previous stage won't be blocked.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        target: Callable,
+        output: queue.Queue,
+        input: queue.Queue | None = None,
+    ) -> None:
+        super().__init__(name=name, daemon=True)
+        self._target_func = target
+        self._output = output
+        self._input = input
+        self.error: Exception | None = None
+
+    def run(self) -> None:
+        try:
+            with logs.span(self.name):
+                self._target_func()
+        except Exception as e:
+            _log.exception("The %s stage of the pipeline failed", self.name)
+            self.error = e
+            if self._input:
+                for _ in _drain(self._input):
+                    pass
+        finally:
+            self._output.put(_END)
+
+
+def _drain(stage_queue: queue.Queue, slots: threading.Semaphore | None = None) -> Iterator[dict]:
+    """Iterate over the queue items until its end. If slots are given, each item takes a slot."""
+    while True:
+        if slots:
+            slots.acquire()
+        item = stage_queue.get()
+        if item is _END:
+            return
+        yield item
+
+
+def run_pipeline(
+    casualties_data: List[dict],
+    json_file: str,
+    iter_casualties_data: Callable[..., Generator[dict, None, List[dict]]],
+    collect_args: tuple,
+    build: bool = False,
+    publisher=None,
+    queue_size: int = 8,
+) -> List[dict]:
+    """
+    Run the collect -> build -> publish stages as a streaming pipeline:
+    each casualty moves to the next stage as soon as it's ready, through bounded queues
+    (so a slow stage holds back the previous ones), and the dataset is updated incrementally.
+    After the newly collected casualties, the rest of the dataset goes through the build
+    and publish stages as well, as in a batch run.
+    """
+    writer = DatasetWriter(casualties_data, json_file)
+    build_queue = queue.Queue(maxsize=queue_size)
+    publish_queue = queue.Queue(maxsize=queue_size)
+    start = time.perf_counter()
+
+    def collect() -> None:
+        output = build_queue if build else publish_queue
+        collector = iter_casualties_data(casualties_data, *collect_args)
+        while True:
+            try:
+                casualty_data = next(collector)
+            except StopIteration as stop:
+                writer.reset(stop.value)
+                break
+            writer.update(casualty_data)
+            output.put(casualty_data)
+        for casualty_data in writer.untouched():
+            output.put(casualty_data)
+
+    def build_posts() -> None:
+        from utils.build_posts import create_casualty_post_worker
+
+        slots = threading.BoundedSemaphore(queue_size)
+        for casualty_data, snapshot in process_pool.imap_unordered(
+            metrics.collecting(create_casualty_post_worker),
+            _drain(build_queue, slots),
+        ):
+            slots.release()
+            metrics.REGISTRY.merge(snapshot)
+            writer.update(casualty_data)
+            publish_queue.put(casualty_data)
+
+    # The processes are forked before any of the stages threads is started
+    process_pool = (
+        multiprocessing.Pool(initializer=logs.worker_initializer, initargs=logs.worker_initargs())
+        if build
+        else None
+    )
+    stages = [_Stage("collect", collect, build_queue if build else publish_queue)]
+    if build:
+        stages.append(_Stage("build", build_posts, publish_queue, build_queue))
+    try:
+        for stage in stages:
+            stage.start()
+
+        first_post = True
+        for casualty_data in _drain(publish_queue):
+            if publisher:
+                published_posts = publisher.posts
+                casualty_data = publisher.publish(casualty_data)
+                if first_post and published_posts < publisher.posts:
+                    metrics.observe("time_to_first_post_seconds", time.perf_counter() - start)
+                    first_post = False
+            writer.update(casualty_data)
+
+        for stage in stages:
+            stage.join()
+    except BaseException:
+        # The (daemon) stages threads may be blocked on the queues which are not drained anymore,
+        # so the posts which are being built are dropped
+        if process_pool:
+            process_pool.terminate()
+        raise
+    finally:
+        if process_pool:
+            process_pool.close()
+            process_pool.join()
+        # The records which were updated so far are saved, even if the publishing failed
+        casualties_data = writer.finish()
+    if publisher:
+        publisher.print_summary()
+    for stage in stages:
+        if stage.error:
+            raise stage.error
+    return casualties_data
@@ -1,26 +1,33 @@
 import os
 import datetime
-from collections import defaultdict
-from typing import List, Tuple
+import multiprocessing
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
 from functools import reduce
 import signal
 import instagrapi.types
 
+from utils import logs, metrics
 from utils.casualty import Casualty, Gender
-from utils.images import remove_duplicates_images
+from utils.image_store import ImageStore
+from utils.images import face_detector_settings, remove_duplicates_images, set_face_detector
+from utils.json_storage import reload_data, write_data
 from utils.instagram import InstagramClient
 from utils.paths import *
 from utils.instagram import InstagramClient
 
 
+_log = logs.get_logger(__name__)
+
 STOP_PUBLISHING = False
 BAD_ATTEMPTS = 0
+_prepared_posts: Dict[str, dict] | None = None  # Of PREPARED_POSTS_FILE, by the casualties data URLs
 
 
 def signal_handler(_sig, _frame):
     """Signal handler for stopping publishment in the middle, without losing data"""
     global STOP_PUBLISHING
-    print("A signal was recieved - Going to stop publishing posts...")
+    _log.warning("A signal was recieved - Going to stop publishing posts...")
     STOP_PUBLISHING = True
 
 
@@ -87,10 +94,84 @@ def _prepare_post_images(casualty: Casualty) -> List[str]:
         casualty.post_additional_images
     )
     if removed:
-        print(f"{len(removed)} duplicates images were removed")
+        _log.info("Duplicates images were removed", extra={"removed": len(removed)})
     return post_images_paths
 
 
+def _detection_key() -> dict:
+    """The face detection options which the crops depend on (the concurrency doesn't change the faces)"""
+    settings = face_detector_settings()
+    del settings["concurrency"]
+    return settings
+
+
+def _prepare_worker_initializer(logs_initargs: tuple, detector_settings: dict) -> None:
+    """Configure the log and the face detector of the worker process (whether it was forked or spawned)"""
+    logs.worker_initializer(*logs_initargs)
+    set_face_detector(**detector_settings)
+
+
+def prepare_casualty_post_images(casualty_data: dict) -> dict:
+    """
+    Prepare the images of the post about the casualty ahead of publishing:
+    without duplications, and ready for Instagram standard.
+    The missing files, and the images which couldn't be cropped, are reported along with them.
+    """
+    casualty: Casualty = Casualty.from_dict(casualty_data)
+    with logs.correlation(casualty.data_url):
+        return _prepare_casualty_post_images(casualty)
+
+
+def _prepare_casualty_post_images(casualty: Casualty) -> dict:
+    source_images = [path for path in casualty.post_additional_images if os.path.isfile(path)]
+    missing = [path for path in casualty.post_additional_images if not os.path.isfile(path)]
+    if casualty.post_path and not os.path.isfile(casualty.post_path):
+        missing.append(casualty.post_path)
+    post_images_paths, removed = remove_duplicates_images(source_images)
+    post_images, crop_failures = [], []
+    for path in post_images_paths:
+        try:
+            post_images.extend(InstagramClient.prepare_images([path]))
+        except Exception as e:
+            _log.warning("Failed to prepare image %s", path, exc_info=True)
+            crop_failures.append(f"{path}: {e}")
+    return {
+        "source_images": source_images,
+        "source_digests": [ImageStore().digest(path) for path in source_images],
+        "detection": _detection_key(),
+        "post_images": post_images,
+        "removed": removed,
+        "missing": missing,
+        "crop_failures": crop_failures,
+    }
+
+
+def _prepared_post_images(casualty: Casualty) -> List[str] | None:
+    """
+    The images of the post which were already prepared (by the validation, or by the work queue),
+    if they were prepared from the current images of the casualty. The images are compared by their
+    content, as a re-downloaded image is written to the same path, and with the current face detection
+    options, which the crops depend on.
+    """
+    global _prepared_posts
+    if _prepared_posts is None:
+        _prepared_posts = reload_data(PREPARED_POSTS_FILE) or {}
+    prepared = _prepared_posts.get(casualty.data_url)
+    if (
+        prepared
+        and not prepared.get("crop_failures")
+        and prepared.get("source_images") == casualty.post_additional_images
+        and prepared.get("detection") == _detection_key()
+        and all(os.path.isfile(path) for path in casualty.post_additional_images)
+        and prepared.get("source_digests")
+        == [ImageStore().digest(path) for path in casualty.post_additional_images]
+        and all(os.path.isfile(path) for path in prepared["post_images"])
+    ):
+        metrics.increment("prepared_posts", result="reused")
+        return prepared["post_images"]
+    return None
+
+
 def _publish_casualty_post(
     casualty: Casualty,
     instagram_client: InstagramClient,
@@ -108,15 +189,21 @@ def _publish_casualty_post(
                 post_hashtags = _prepare_post_hashtags(casualty)
                 post_cation = f"{post_text}\n{post_hashtags}"
                 casualty.post_caption = post_cation
-                post_images_paths = _prepare_post_images(casualty)
+                prepared_images_paths = _prepared_post_images(casualty)
+                post_images_paths = (
+                    prepared_images_paths
+                    if prepared_images_paths is not None
+                    else _prepare_post_images(casualty)
+                )
                 published = instagram_client.publish_post(
                     post_cation,
                     casualty.post_path,
                     post_images_paths,
                     dry_run,
+                    prepared=prepared_images_paths is not None,
                 )
                 if published and not dry_run:
-                    print(f"The post about {casualty} was published' successfully.")
+                    _log.info("The post about %s was published successfully", casualty)
                     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     if test:
                         casualty.post_tested = timestamp
@@ -124,12 +211,10 @@ def _publish_casualty_post(
                         casualty.post_published = timestamp
 
             else:
-                print(f"No post to publish for {casualty}")
+                _log.warning("No post to publish for %s", casualty)
 
-    except Exception as e:
-        print(
-            f"Couldn't publish the post for {casualty}:\n{e}\n\nGoing to stop publishing posts..."
-        )
+    except Exception:
+        _log.exception("Couldn't publish the post for %s", casualty)
         if 2 < BAD_ATTEMPTS:
             STOP_PUBLISHING = True
         else:
@@ -138,71 +223,175 @@ def _publish_casualty_post(
     return casualty, published, len(post_images_paths)
 
 
-def publish_casualties_posts(
-    given_casualties_data: List[dict],
-    instagram_user: str,
-    intagram_password: str,
-    posts_limit: int,
-    min_images: int,
-    names: List[str],
-    test: bool = False,
-    dry_run: bool = False,
-) -> List[dict]:
-    """Publish posts about all the casualties, one per each"""
-    signal.signal(signal.SIGINT, signal_handler)
+def is_publish_candidate(casualty: Casualty, test: bool, names: List[str]) -> bool:
+    """Whether a post about the casualty is waiting to be published (regardless of the posts limit)"""
+    return (
+        (
+            test
+            and ((not casualty.post_tested and not casualty.post_published) or names)
+        )
+        or (not test and casualty.post_tested and not casualty.post_published)
+    ) and (not names or any([name in casualty.full_name for name in names]))
+
+
+class CasualtiesPublisher:
+    """Publish posts one casualty at a time, while keeping the limits and the summary of the whole run"""
 
-    updated_casualties_data = []
-    instagram_client = InstagramClient(instagram_user, intagram_password)
-    posts = 0
-    images_per_posts = defaultdict(lambda: [])
+    def __init__(
+        self,
+        instagram_user: str,
+        intagram_password: str,
+        posts_limit: int,
+        min_images: int,
+        names: List[str],
+        test: bool = False,
+        dry_run: bool = False,
+    ) -> None:
+        signal.signal(signal.SIGINT, signal_handler)
+        self.instagram_client = InstagramClient(instagram_user, intagram_password)
+        self.posts_limit = posts_limit
+        self.min_images = min_images
+        self.names = names
+        self.test = test
+        self.dry_run = dry_run
+        self.posts = 0
+        self.images_per_posts = defaultdict(lambda: [])
 
-    for casualty_data in given_casualties_data:
+    def _is_candidate(self, casualty: Casualty) -> bool:
+        """Whether a post about the casualty should be published now"""
+        return is_publish_candidate(casualty, self.test, self.names) and (
+            self.posts_limit is None or self.posts < self.posts_limit
+        )
+
+    def publish(self, casualty_data: dict) -> dict:
+        """Publish a post about the casualty, if required, and return its updated data"""
         casualty: Casualty = Casualty.from_dict(casualty_data)
-        if (
-            (
-                (
-                    test
-                    and (
-                        (not casualty.post_tested and not casualty.post_published)
-                        or names
-                    )
-                )
-                or (not test and casualty.post_tested and not casualty.post_published)
-            )
-            and (not names or any([name in casualty.full_name for name in names]))
-            and (posts_limit is None or posts < posts_limit)
-        ):
+        with logs.correlation(casualty.data_url):
+            return self._publish(casualty).to_dict()
+
+    def _publish(self, casualty: Casualty) -> Casualty:
+        if self._is_candidate(casualty):
             casualty.post_additional_images = [
                 path for path in casualty.post_additional_images if os.path.isfile(path)
             ]
-            if min_images and (
+            if self.min_images and (
                 not casualty.post_additional_images
-                or len(casualty.post_additional_images) < min_images
+                or len(casualty.post_additional_images) < self.min_images
             ):
-                print(
-                    f"\nNot enough images - the post about {casualty} won't be published."
+                _log.warning(
+                    "Not enough images - the post about %s won't be published",
+                    casualty,
+                    extra={"images": len(casualty.post_additional_images)},
                 )
             else:
                 casualty, published, num_of_images = _publish_casualty_post(
                     casualty,
-                    instagram_client=instagram_client,
-                    test=test,
-                    dry_run=dry_run,
+                    instagram_client=self.instagram_client,
+                    test=self.test,
+                    dry_run=self.dry_run,
                 )
                 if published:
-                    posts += 1
-                    images_per_posts[num_of_images].append(casualty)
+                    self.posts += 1
+                    self.images_per_posts[num_of_images].append(casualty)
 
-        updated_casualties_data.append(casualty.to_dict())
+        return casualty
 
-    print(
-        f"\n{posts} posts were {'prepared' if dry_run else 'published'}. Number of images in each posts:"
-    )
-    print(
-        "\n".join(
-            f"{images}: {len(posts)} posts ({[casualty.full_name for casualty in posts] if 1 < images else ''})"
-            for images, posts in images_per_posts.items()
+    def print_summary(self) -> None:
+        print(
+            f"\n{self.posts} posts were {'prepared' if self.dry_run else 'published'}. Number of images in each posts:"
         )
-    )
+        print(
+            "\n".join(
+                f"{images}: {len(posts)} posts ({[casualty.full_name for casualty in posts] if 1 < images else ''})"
+                for images, posts in self.images_per_posts.items()
+            )
+        )
+
 
+def publish_casualties_posts(
+    given_casualties_data: List[dict],
+    instagram_user: str,
+    intagram_password: str,
+    posts_limit: int,
+    min_images: int,
+    names: List[str],
+    test: bool = False,
+    dry_run: bool = False,
+) -> List[dict]:
+    """Publish posts about all the casualties, one per each"""
+    publisher = CasualtiesPublisher(
+        instagram_user, intagram_password, posts_limit, min_images, names, test, dry_run
+    )
+    updated_casualties_data = [
+        publisher.publish(casualty_data) for casualty_data in given_casualties_data
+    ]
+    publisher.print_summary()
     return updated_casualties_data
+
+
+def validate_casualties_posts(
+    given_casualties_data: List[dict],
+    min_images: int,
+    names: List[str],
+    test: bool = False,
+) -> dict:
+    """
+    Validate the posts of the whole publish backlog (regardless of the posts limit) over a processes pool:
+    prepare their images as the publish would, and report the problems it would run into.
+    The prepared images are saved, and reused by the publish. The report (the problems of each post,
+    and a summary) is saved to VALIDATION_REPORT_FILE, and returned.
+    """
+    global _prepared_posts
+    candidates = [
+        casualty_data
+        for casualty_data in given_casualties_data
+        if is_publish_candidate(Casualty.from_dict(casualty_data), test, names)
+    ]
+    with multiprocessing.Pool(
+        initializer=_prepare_worker_initializer,
+        initargs=(logs.worker_initargs(), face_detector_settings()),
+    ) as process_pool:
+        results = metrics.pool_map(process_pool, prepare_casualty_post_images, candidates)
+    prepared_posts = reload_data(PREPARED_POSTS_FILE) or {}
+    images_per_posts, posts_reports = Counter(), {}
+    for casualty_data, result in zip(candidates, results):
+        prepared_posts[casualty_data["data_url"]] = result
+        casualty = Casualty.from_dict(casualty_data)
+        # The built post is the first image of the published post
+        images_per_posts[1 + len(result["post_images"])] += 1
+        problems = []
+        if not casualty.post_path:
+            problems.append("no post was built")
+        if min_images and len(result["source_images"]) < min_images:
+            problems.append(f"not enough images ({len(result['source_images'])})")
+        problems.extend(f"missing file {path}" for path in result["missing"])
+        problems.extend(f"crop failure {failure}" for failure in result["crop_failures"])
+        with logs.correlation(casualty.data_url):
+            for problem in problems:
+                _log.warning("The post about %s would fail: %s", casualty, problem)
+        posts_reports[casualty.data_url] = {
+            "casualty": str(casualty),
+            "images": 1 + len(result["post_images"]),
+            "removed": result["removed"],
+            "problems": problems,
+        }
+    write_data(prepared_posts, PREPARED_POSTS_FILE)
+    _prepared_posts = prepared_posts
+    summary = {
+        "posts": len(candidates),
+        "failed_posts": sum(1 for report in posts_reports.values() if report["problems"]),
+        "images_per_posts": {str(images): posts for images, posts in sorted(images_per_posts.items())},
+        "missing": sum(len(result["missing"]) for result in results),
+        "removed": sum(len(result["removed"]) for result in results),
+        "crop_failures": sum(len(result["crop_failures"]) for result in results),
+    }
+    report = {"summary": summary, "posts": posts_reports}
+    write_data(report, VALIDATION_REPORT_FILE)
+    _log.info(
+        "%d posts were validated (%d would fail), and the report was saved to %s",
+        summary["posts"],
+        summary["failed_posts"],
+        VALIDATION_REPORT_FILE,
+        extra=summary,
+    )
+    return report
@@ -0,0 +1,294 @@
+"""
+Deterministic sharding of the datasets between machines, and merging the shards outputs back.
+
+Each machine runs its slice, e.g. "python memorialization.py ... --build --shard 0/4",
+and the shards directories are then merged into the main dataset:
+
+    python -m utils.shards merge -json iron_swords.paths shards/iron_swords/build/*-of-4
+    python -m utils.shards merge-collect -func iron_swords.scrap -json iron_swords.paths shards/iron_swords/collect/*-of-4
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from utils import logs
+from utils.json_storage import reload_data, write_data
+from utils.paths import SHARDS_DIR
+
+RECORDS_FILE_NAME = "records.json"
+
+_log = logs.get_logger(__name__)
+
+
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.index}-of-{self.count}"
+
+
+def parse_shard(value: str) -> Shard:
+    """argparse type of a shard, given as "i/N" (0 <= i < N)"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid shard "{value}", expected "i/N"')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'Invalid shard "{value}", expected 0 <= i < N')
+    return Shard(index, count)
+
+
+def shard_of(data_url: str, count: int) -> int:
+    """The shard of the URL, stable across machines and runs (unlike the builtin hash)"""
+    key = data_url.replace("https://", "")
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big") % count
+
+
+def select(casualties_data: List[dict], shard: Shard) -> List[dict]:
+    """The records of the given shard"""
+    return [
+        casualty_data
+        for casualty_data in casualties_data
+        if shard_of(casualty_data["data_url"], shard.count) == shard.index
+    ]
+
+
+def fingerprint(casualty_data: dict) -> str:
+    return hashlib.sha256(
+        json.dumps(casualty_data, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def shard_dir(json_file: str, shard: Shard, stage: str) -> str:
+    dataset_name = os.path.splitext(os.path.basename(json_file))[0]
+    return os.path.join(SHARDS_DIR, dataset_name, stage, shard.name)
+
+
+def _copy(source: str, target: str) -> None:
+    Path(os.path.dirname(target)).mkdir(parents=True, exist_ok=True)
+    shutil.copy2(source, target)
+
+
+def _export_file(path: str, target_dir: str) -> str:
+    """
+    Copy the file into the shard directory, and return its path relative to the working
+    directory, as the shard is merged on another machine.
+    Files outside of the working directory (e.g. of the external images pool) are kept as they are.
+    """
+    relative_path = os.path.relpath(path, os.getcwd())
+    if relative_path.startswith(os.pardir):
+        return path
+    _copy(path, os.path.join(target_dir, relative_path))
+    return relative_path
+
+
+def _import_file(path: str, shard_dir_path: str) -> str:
+    """Copy the file of the shard directory into the working directory, and return its path"""
+    if os.path.isabs(path):
+        return path
+    _copy(os.path.join(shard_dir_path, path), path)
+    return os.path.join(os.getcwd(), path)
+
+
+def write_build_shard(
+    json_file: str, shard: Shard, base_data: List[dict], built_data: List[dict]
+) -> str:
+    """
+    Save the build outputs of the shard into its directory: the updated records, along with the
+    fingerprints of the records they were built from, and the posts they refer to.
+    """
+    target_dir = shard_dir(json_file, shard, "build")
+    records = []
+    for base, record in zip(base_data, built_data):
+        if fingerprint(base) == fingerprint(record):
+            continue
+        record = dict(record)
+        post_path = record.get("post_path")
+        if post_path and os.path.isfile(post_path):
+            record["post_path"] = _export_file(post_path, target_dir)
+        records.append({"base": fingerprint(base), "record": record})
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    write_data(records, os.path.join(target_dir, RECORDS_FILE_NAME))
+    _log.info(
+        "%d updated records of shard %s were saved to %s", len(records), shard.name, target_dir
+    )
+    return target_dir
+
+
+def merge_build_shards(json_file: str, shards_dirs: List[str]) -> List[str]:
+    """
+    Apply the records updates of the shards to the dataset, and copy their posts.
+    A record which was updated in several shards, or was changed in the dataset since
+    its shard was built, is a conflict: it's not applied, and it's reported.
+    """
+    casualties_data = reload_data(json_file)
+    indexes = {
+        casualty_data["data_url"]: i for i, casualty_data in enumerate(casualties_data)
+    }
+    updates: Dict[str, List[Tuple[str, dict]]] = defaultdict(list)
+    for dir_path in shards_dirs:
+        for entry in reload_data(os.path.join(dir_path, RECORDS_FILE_NAME)):
+            updates[entry["record"]["data_url"]].append((dir_path, entry))
+
+    conflicts = []
+    for data_url, entries in updates.items():
+        if 1 < len(entries):
+            conflicts.append(
+                f"{data_url} was updated in several shards: {', '.join(dir_path for dir_path, _ in entries)}"
+            )
+            continue
+        dir_path, entry = entries[0]
+        if data_url not in indexes:
+            conflicts.append(f"{data_url} (of {dir_path}) is not in the dataset anymore")
+            continue
+        record = entry["record"]
+        post_path = record.get("post_path")
+        if post_path:
+            record["post_path"] = os.path.abspath(post_path)
+        current_fingerprint = fingerprint(casualties_data[indexes[data_url]])
+        if current_fingerprint == fingerprint(record):
+            continue  # Already merged
+        if current_fingerprint != entry["base"]:
+            conflicts.append(
+                f"{data_url} (of {dir_path}) was changed in the dataset since the shard was built"
+            )
+            continue
+        if post_path:
+            _import_file(post_path, dir_path)
+        casualties_data[indexes[data_url]] = record
+
+    write_data(casualties_data, json_file)
+    _log.info(
+        "%d records of %d shards were merged into %s",
+        len(updates) - len(conflicts),
+        len(shards_dirs),
+        json_file,
+    )
+    for conflict in conflicts:
+        _log.warning("Conflict: %s", conflict)
+    return conflicts
+
+
+def write_collect_shard(json_file: str, shard: Shard, collected_data: List[dict]) -> str:
+    """Save the partial dataset which was collected by the shard, along with its images, into its directory"""
+    target_dir = shard_dir(json_file, shard, "collect")
+    records = []
+    for record in collected_data:
+        record = dict(record)
+        if record.get("post_main_image") and os.path.isfile(record["post_main_image"]):
+            record["post_main_image"] = _export_file(record["post_main_image"], target_dir)
+        record["post_additional_images"] = [
+            _export_file(path, target_dir)
+            for path in record.get("post_additional_images") or []
+            if os.path.isfile(path)
+        ]
+        records.append(record)
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    write_data(records, os.path.join(target_dir, RECORDS_FILE_NAME))
+    _log.info(
+        "%d collected records of shard %s were saved to %s", len(records), shard.name, target_dir
+    )
+    return target_dir
+
+
+def merge_collect_shards(
+    json_file: str,
+    shards_dirs: List[str],
+    merge_casualties_data: Callable[[List[dict], List[dict]], List[dict]],
+) -> List[str]:
+    """
+    Merge the partial datasets of the collect shards into the dataset, with the identity rules
+    of the dataset's collection (its merge_casualties_data function), and copy their images.
+    A URL which was collected by several shards is a conflict: only its first record is merged.
+    """
+    collected_data, shards_of_urls, conflicts = [], {}, []
+    for dir_path in shards_dirs:
+        for record in reload_data(os.path.join(dir_path, RECORDS_FILE_NAME)):
+            url_key = record["data_url"].replace("https://", "")
+            if url_key in shards_of_urls:
+                conflicts.append(
+                    f"{record['data_url']} was collected by several shards: {shards_of_urls[url_key]}, {dir_path}"
+                )
+                continue
+            shards_of_urls[url_key] = dir_path
+            if record.get("post_main_image"):
+                record["post_main_image"] = _import_file(record["post_main_image"], dir_path)
+            record["post_additional_images"] = [
+                _import_file(path, dir_path) for path in record["post_additional_images"]
+            ]
+            collected_data.append(record)
+    casualties_data = merge_casualties_data(reload_data(json_file), collected_data)
+    write_data(casualties_data, json_file)
+    _log.info(
+        "%d records of %d shards were merged into %s",
+        len(collected_data),
+        len(shards_dirs),
+        json_file,
+    )
+    for conflict in conflicts:
+        _log.warning("Conflict: %s", conflict)
+    return conflicts
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m utils.shards",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    merge_parser = subparsers.add_parser(
+        "merge", help="Merge the build shards into the main dataset"
+    )
+    merge_parser.add_argument(
+        "-json",
+        "--json_path_package",
+        required=True,
+        help='Relative python package path, e.g. "iron_swords.paths", that includes JSON_FILE path',
+    )
+    merge_parser.add_argument("shards_dirs", nargs="+")
+    merge_parser.set_defaults(
+        merge=lambda json_file, args: merge_build_shards(json_file, args.shards_dirs)
+    )
+
+    merge_collect_parser = subparsers.add_parser(
+        "merge-collect", help="Merge the collect shards into the main dataset"
+    )
+    merge_collect_parser.add_argument(
+        "-func",
+        "--scrap_function_package",
+        required=True,
+        help='Relative python package path, e.g. "iron_swords.scrap", that includes merge_casualties_data function',
+    )
+    merge_collect_parser.add_argument(
+        "-json",
+        "--json_path_package",
+        required=True,
+        help='Relative python package path, e.g. "iron_swords.paths", that includes JSON_FILE path',
+    )
+    merge_collect_parser.add_argument("shards_dirs", nargs="+")
+    merge_collect_parser.set_defaults(
+        merge=lambda json_file, args: merge_collect_shards(
+            json_file,
+            args.shards_dirs,
+            importlib.import_module(args.scrap_function_package).merge_casualties_data,
+        )
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logs.configure()
+    json_file = importlib.import_module(args.json_path_package).JSON_FILE
+    if args.merge(json_file, args):
+        sys.exit(1)
@@ -0,0 +1,468 @@
+"""
+Durable queue of per-casualty tasks, pulled by any number of worker processes of the machine
+(the queue is a local SQLite database, which can't be shared over a network filesystem).
+Each task is leased by one worker at a time: a task whose worker died becomes visible again once
+its lease expires, and a failed task is retried up to the maximal number of attempts.
+A task is enqueued once per casualty and kind, so enqueueing again (e.g. after applying the results,
+which changes the records) adds only the new casualties, unless the tasks are explicitly --reset.
+
+    python -m utils.work_queue enqueue build -func iron_swords.scrap -json iron_swords.paths
+    python -m utils.work_queue work build -func iron_swords.scrap -json iron_swords.paths --workers 4
+    python -m utils.work_queue status
+    python -m utils.work_queue apply build -func iron_swords.scrap -json iron_swords.paths
+
+The kinds of tasks are "collect" (a casualty page), "build" (a casualty post)
+and "prepare" (the images of a casualty post, ahead of publishing).
+"""
+import abc
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict
+
+from utils import logs, metrics
+from utils.json_storage import reload_data, write_data
+from utils.paths import METRICS_DIR, PREPARED_POSTS_FILE, WORK_QUEUE_FILE
+from utils.shards import fingerprint
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+KINDS = ["collect", "build", "prepare"]
+
+_log = logs.get_logger(__name__)
+
+
+@dataclass
+class Task:
+    id: int
+    kind: str
+    key: str
+    payload: Any
+    attempts: int
+    owner: str
+
+
+class WorkQueue(abc.ABC):
+    """
+    The queue interface. SqliteWorkQueue is the durable one, and MemoryWorkQueue is its in-process stand-in.
+    """
+
+    def __init__(self, lease_seconds: float = 600, max_attempts: int = 3) -> None:
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    @abc.abstractmethod
+    def put(self, kind: str, key: str, payload: Any, reset: bool = False) -> None:
+        """Add a task, unless the kind already has a task of the key (then it's reset only if asked to)"""
+
+    @abc.abstractmethod
+    def lease(self, kind: str, owner: str) -> Task | None:
+        """Take the next visible task of the kind, for the lease duration"""
+
+    @abc.abstractmethod
+    def complete(self, task: Task, result: Any) -> bool:
+        """Save the result of the task, unless its lease was lost (then it returns False)"""
+
+    @abc.abstractmethod
+    def fail(self, task: Task, error: str) -> None:
+        """Release the task for a retry, or mark it as failed after the maximal attempts"""
+
+    @abc.abstractmethod
+    def progress(self, kind: str) -> Dict[str, int]:
+        """Number of tasks of the kind in each status"""
+
+    @abc.abstractmethod
+    def results(self, kind: str) -> Dict[str, Any]:
+        """The results of the done tasks of the kind, by their keys"""
+
+    @abc.abstractmethod
+    def payloads(self, kind: str) -> Dict[str, Any]:
+        """The payloads of the tasks of the kind, by their keys"""
+
+    def unfinished(self, kind: str) -> bool:
+        progress = self.progress(kind)
+        return 0 < progress.get(PENDING, 0) + progress.get(LEASED, 0)
+
+
+class MemoryWorkQueue(WorkQueue):
+    """In-process work queue, with the same semantics as SqliteWorkQueue (for tests and single runs)"""
+
+    def __init__(self, lease_seconds: float = 600, max_attempts: int = 3) -> None:
+        super().__init__(lease_seconds, max_attempts)
+        self._tasks: Dict[int, dict] = {}
+        self._keys: Dict[tuple, int] = {}
+        self._lock = threading.Lock()
+
+    def put(self, kind: str, key: str, payload: Any, reset: bool = False) -> None:
+        with self._lock:
+            task_id = self._keys.get((kind, key))
+            if task_id is not None and not reset:
+                return
+            if task_id is None:
+                task_id = self._keys[(kind, key)] = len(self._tasks) + 1
+            self._tasks[task_id] = {
+                "kind": kind,
+                "key": key,
+                "payload": payload,
+                "status": PENDING,
+                "attempts": 0,
+                "owner": None,
+                "lease_expires": None,
+                "result": None,
+                "error": None,
+            }
+
+    def lease(self, kind: str, owner: str) -> Task | None:
+        now = time.time()
+        with self._lock:
+            for task_id, task in self._tasks.items():
+                if task["kind"] != kind:
+                    continue
+                expired = task["status"] == LEASED and task["lease_expires"] < now
+                if expired and self.max_attempts <= task["attempts"]:
+                    task.update(status=FAILED, owner=None, error="The lease was expired")
+                    continue
+                if task["status"] == PENDING or expired:
+                    task.update(
+                        status=LEASED,
+                        owner=owner,
+                        lease_expires=now + self.lease_seconds,
+                        attempts=task["attempts"] + 1,
+                    )
+                    return Task(
+                        task_id, kind, task["key"], task["payload"], task["attempts"], owner
+                    )
+        return None
+
+    def complete(self, task: Task, result: Any) -> bool:
+        with self._lock:
+            stored = self._tasks[task.id]
+            if stored["status"] != LEASED or stored["owner"] != task.owner:
+                return False
+            stored.update(status=DONE, owner=None, result=result)
+            return True
+
+    def fail(self, task: Task, error: str) -> None:
+        with self._lock:
+            stored = self._tasks[task.id]
+            if stored["status"] == LEASED and stored["owner"] == task.owner:
+                stored.update(
+                    status=PENDING if stored["attempts"] < self.max_attempts else FAILED,
+                    owner=None,
+                    error=error,
+                )
+
+    def progress(self, kind: str) -> Dict[str, int]:
+        progress: Dict[str, int] = {}
+        with self._lock:
+            for task in self._tasks.values():
+                if task["kind"] == kind:
+                    progress[task["status"]] = progress.get(task["status"], 0) + 1
+        return progress
+
+    def results(self, kind: str) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                task["key"]: task["result"]
+                for task in self._tasks.values()
+                if task["kind"] == kind and task["status"] == DONE
+            }
+
+    def payloads(self, kind: str) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                task["key"]: task["payload"]
+                for task in self._tasks.values()
+                if task["kind"] == kind
+            }
+
+
+class SqliteWorkQueue(WorkQueue):
+    """
+    Work queue in a local SQLite database (in WAL mode), shared by the worker processes of the machine
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_expires REAL,
+            result TEXT,
+            error TEXT,
+            UNIQUE (kind, key)
+        )
+    """
+
+    def __init__(
+        self, path: str = WORK_QUEUE_FILE, lease_seconds: float = 600, max_attempts: int = 3
+    ) -> None:
+        super().__init__(lease_seconds, max_attempts)
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(self.SCHEMA)
+
+    def put(self, kind: str, key: str, payload: Any, reset: bool = False) -> None:
+        self._connection.execute(
+            """
+            INSERT INTO tasks (kind, key, payload) VALUES (?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                payload = excluded.payload, status = 'pending', attempts = 0,
+                owner = NULL, lease_expires = NULL, result = NULL, error = NULL
+            WHERE ?
+            """,
+            (kind, key, json.dumps(payload, ensure_ascii=False, sort_keys=True), reset),
+        )
+
+    def lease(self, kind: str, owner: str) -> Task | None:
+        now = time.time()
+        cursor = self._connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(
+                """
+                UPDATE tasks SET status = 'failed', owner = NULL, error = 'The lease was expired'
+                WHERE kind = ? AND status = 'leased' AND lease_expires < ? AND ? <= attempts
+                """,
+                (kind, now, self.max_attempts),
+            )
+            row = cursor.execute(
+                """
+                SELECT id, key, payload, attempts FROM tasks
+                WHERE kind = ? AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?))
+                ORDER BY id LIMIT 1
+                """,
+                (kind, now),
+            ).fetchone()
+            if row:
+                cursor.execute(
+                    """
+                    UPDATE tasks SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1
+                    WHERE id = ?
+                    """,
+                    (owner, now + self.lease_seconds, row[0]),
+                )
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        if not row:
+            return None
+        task_id, key, payload, attempts = row
+        return Task(task_id, kind, key, json.loads(payload), attempts + 1, owner)
+
+    def complete(self, task: Task, result: Any) -> bool:
+        cursor = self._connection.execute(
+            """
+            UPDATE tasks SET status = 'done', owner = NULL, result = ?
+            WHERE id = ? AND status = 'leased' AND owner = ?
+            """,
+            (json.dumps(result, ensure_ascii=False), task.id, task.owner),
+        )
+        return 0 < cursor.rowcount
+
+    def fail(self, task: Task, error: str) -> None:
+        self._connection.execute(
+            """
+            UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                owner = NULL, error = ?
+            WHERE id = ? AND status = 'leased' AND owner = ?
+            """,
+            (self.max_attempts, error, task.id, task.owner),
+        )
+
+    def progress(self, kind: str) -> Dict[str, int]:
+        return dict(
+            self._connection.execute(
+                "SELECT status, COUNT(*) FROM tasks WHERE kind = ? GROUP BY status", (kind,)
+            ).fetchall()
+        )
+
+    def results(self, kind: str) -> Dict[str, Any]:
+        return {
+            key: json.loads(result)
+            for key, result in self._connection.execute(
+                "SELECT key, result FROM tasks WHERE kind = ? AND status = 'done'", (kind,)
+            )
+        }
+
+    def payloads(self, kind: str) -> Dict[str, Any]:
+        return {
+            key: json.loads(payload)
+            for key, payload in self._connection.execute(
+                "SELECT key, payload FROM tasks WHERE kind = ?", (kind,)
+            )
+        }
+
+
+def work(
+    queue: WorkQueue,
+    kind: str,
+    handler: Callable[[Any], Any],
+    owner: str,
+    poll_seconds: float = 5,
+) -> int:
+    """Pull the tasks of the kind and handle them, until no task is left. Return the number of handled tasks."""
+    handled = 0
+    while True:
+        task = queue.lease(kind, owner)
+        if task is None:
+            if not queue.unfinished(kind):
+                return handled
+            # The other tasks are leased by other workers, and may become visible again
+            time.sleep(poll_seconds)
+            continue
+        try:
+            with metrics.timer("work_queue_task_seconds", kind=kind), logs.correlation(task.key):
+                result = handler(task.payload)
+        except Exception as e:
+            with logs.correlation(task.key):
+                _log.warning(
+                    "The %s task failed", kind, exc_info=True, extra={"attempt": task.attempts}
+                )
+            metrics.increment("work_queue_failures", kind=kind)
+            queue.fail(task, str(e))
+            continue
+        if queue.complete(task, result):
+            handled += 1
+        else:
+            metrics.increment("work_queue_lost_leases", kind=kind)
+
+
+def _handler(kind: str, scrap_function_package: str) -> Callable[[Any], Any]:
+    if kind == "collect":
+        collect_casualty = importlib.import_module(scrap_function_package).collect_casualty
+        return lambda payload: collect_casualty(payload["url"]).to_dict()
+    if kind == "build":
+        from utils.build_posts import create_casualty_post_worker
+
+        return create_casualty_post_worker
+    from utils.publish_posts import prepare_casualty_post_images
+
+    return prepare_casualty_post_images
+
+
+def _work_process(args: argparse.Namespace) -> int:
+    queue = SqliteWorkQueue(args.queue, args.lease_seconds, args.max_attempts)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    return work(queue, args.kind, _handler(args.kind, args.scrap_function_package), owner)
+
+
+def enqueue(args: argparse.Namespace, json_file: str) -> None:
+    queue = SqliteWorkQueue(args.queue, args.lease_seconds, args.max_attempts)
+    casualties_data = reload_data(json_file)
+    if args.kind == "collect":
+        scrap_module = importlib.import_module(args.scrap_function_package)
+        exist_urls = {
+            casualty_data["data_url"].replace("https://", ""): casualty_data
+            for casualty_data in casualties_data
+        }
+        for url in scrap_module.collect_casualties_urls(
+            scrap_module.CASUALTIES_LIST_URL, args.pages_limit
+        ):
+            exist_casualty_data = exist_urls.get(url.replace("https://", ""))
+            if not exist_casualty_data or (
+                args.recollect and not exist_casualty_data["post_published"]
+            ):
+                queue.put("collect", url, {"url": url}, args.reset)
+    else:
+        for casualty_data in casualties_data:
+            if not casualty_data["post_published"] and (
+                args.kind == "build" or casualty_data["post_path"]
+            ):
+                queue.put(args.kind, casualty_data["data_url"], casualty_data, args.reset)
+    _log.info("The %s tasks were enqueued", args.kind, extra={"progress": queue.progress(args.kind)})
+
+
+def apply(args: argparse.Namespace, json_file: str) -> None:
+    """Apply the results of the done tasks to the dataset"""
+    queue = SqliteWorkQueue(args.queue, args.lease_seconds, args.max_attempts)
+    results = queue.results(args.kind)
+    casualties_data = reload_data(json_file)
+    if args.kind == "collect":
+        merge_casualties_data = importlib.import_module(
+            args.scrap_function_package
+        ).merge_casualties_data
+        write_data(merge_casualties_data(casualties_data, list(results.values())), json_file)
+    elif args.kind == "build":
+        # A record which was changed since its task was enqueued is not overridden
+        payloads = {
+            key: fingerprint(payload)
+            for key, payload in queue.payloads("build").items()
+        }
+        applied = 0
+        for i, casualty_data in enumerate(casualties_data):
+            data_url = casualty_data["data_url"]
+            if data_url in results and payloads[data_url] == fingerprint(casualty_data):
+                casualties_data[i] = results[data_url]
+                applied += 1
+        write_data(casualties_data, json_file)
+        _log.info("%d of %d built records were applied", applied, len(results))
+    else:
+        write_data({**(reload_data(PREPARED_POSTS_FILE) or {}), **results}, PREPARED_POSTS_FILE)
+        _log.info("%d prepared posts were saved to %s", len(results), PREPARED_POSTS_FILE)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m utils.work_queue",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--queue", default=WORK_QUEUE_FILE, help="The queue database file")
+    parser.add_argument("--lease_seconds", type=float, default=600)
+    parser.add_argument("--max_attempts", type=int, default=3)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help in [
+        ("enqueue", "Add the tasks of the dataset to the queue"),
+        ("work", "Pull tasks from the queue and handle them"),
+        ("apply", "Apply the results of the done tasks to the dataset"),
+    ]:
+        command_parser = subparsers.add_parser(command, help=help)
+        command_parser.add_argument("kind", choices=KINDS)
+        command_parser.add_argument("-func", "--scrap_function_package", required=True)
+        command_parser.add_argument("-json", "--json_path_package", required=True)
+        if command == "enqueue":
+            command_parser.add_argument("--pages_limit", type=int)
+            command_parser.add_argument("--recollect", action="store_true")
+            command_parser.add_argument(
+                "--reset",
+                action="store_true",
+                help="Enqueue again the casualties which already have tasks (with their current records)",
+            )
+        if command == "work":
+            command_parser.add_argument(
+                "--workers", type=int, default=1, help="Number of worker processes"
+            )
+    subparsers.add_parser("status", help="Print the progress of the tasks")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logs.configure()
+    if args.command == "status":
+        queue = SqliteWorkQueue(args.queue, args.lease_seconds, args.max_attempts)
+        for kind in KINDS:
+            print(f"{kind}: {queue.progress(kind)}")
+    elif args.command == "work":
+        with multiprocessing.Pool(
+            args.workers, initializer=logs.worker_initializer, initargs=logs.worker_initargs()
+        ) as process_pool:
+            handled = metrics.pool_map(process_pool, _work_process, [args] * args.workers)
+        _log.info("%d %s tasks were handled", sum(handled), args.kind)
+        metrics.export(os.path.join(METRICS_DIR, f"work_queue_{args.kind}"))
+    else:
+        json_file = importlib.import_module(args.json_path_package).JSON_FILE
+        {"enqueue": enqueue, "apply": apply}[args.command](args, json_file)